@@ -0,0 +1,131 @@
+'''
+Shows request latency while Chargify degrades, with and without a circuit
+breaker. A local stand-in server, run in its own process, first answers
+every request after a long delay and then recovers. Without the breaker
+each request waits out the read timeout; with it the subscriptions circuit
+opens after a few timeouts, later requests fail fast, and once the server
+recovers a half-open probe closes the circuit again.
+
+    python benchmarks/breaker.py [requests] [threads] [delay_ms] [timeout_ms]
+'''
+
+import BaseHTTPServer
+import SocketServer
+import httplib
+import multiprocessing
+import os
+import sys
+import time
+
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pychargify.api import Chargify, ChargifyConnectionPool, ChargifyError
+from pychargify.breaker import ChargifyCircuitBreaker, ChargifyCircuitOpen
+
+BODY = '<?xml version="1.0" encoding="UTF-8"?><subscription><id>1</id>' \
+    '<state>active</state></subscription>'
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    delay = None
+
+    def do_GET(self):
+        time.sleep(self.delay.value)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address):
+        # Clients hang up on requests that outlive their read timeout
+        pass
+
+
+class PlainPool(ChargifyConnectionPool):
+
+    def __init__(self, host, port, maxsize, read_timeout):
+        ChargifyConnectionPool.__init__(self, host, maxsize, 1, read_timeout)
+        self.port = port
+
+    def _new_connection(self):
+        return httplib.HTTPConnection(self.host, self.port,
+            timeout=self.connect_timeout)
+
+
+def serve(delay, ports):
+    Handler.delay = delay
+    server = Server(('127.0.0.1', 0), Handler)
+    ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def call(chargify):
+    start = time.time()
+    try:
+        chargify.Subscriptions.getById(1)
+        outcome = 'ok'
+    except ChargifyCircuitOpen:
+        outcome = 'fast-fail'
+    except (ChargifyError, EnvironmentError):
+        outcome = 'timeout'
+    return outcome, time.time() - start
+
+
+def run(label, chargify, requests, threads):
+    pool = ThreadPool(threads)
+    start = time.time()
+    results = pool.map(lambda i: call(chargify), range(requests))
+    elapsed = time.time() - start
+    pool.close()
+    latencies = sorted(r[1] * 1000 for r in results)
+    counts = {}
+    for outcome, latency in results:
+        counts[outcome] = counts.get(outcome, 0) + 1
+    print '%-22s %6.2fs  p50 %7.1fms  p99 %7.1fms  max %7.1fms  %s' % (
+        label, elapsed, latencies[len(latencies) / 2],
+        latencies[int(len(latencies) * 0.99)], latencies[-1],
+        ' '.join('%s=%d' % item for item in sorted(counts.items())))
+
+
+def main(requests=200, threads=20, delay_ms=2000, timeout_ms=250):
+    delay = multiprocessing.Value('d', delay_ms / 1000.0)
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(delay, ports))
+    process.daemon = True
+    process.start()
+    port = ports.get()
+    timeout = timeout_ms / 1000.0
+
+    def client(breaker=None):
+        return Chargify('key', 'subdomain', breaker=breaker,
+            transport=PlainPool('127.0.0.1', port, threads, timeout))
+
+    run('degraded, no breaker', client(), requests, threads)
+
+    breaker = ChargifyCircuitBreaker(slow_threshold=timeout,
+        reset_timeout=1.0)
+    chargify = client(breaker)
+    run('degraded, breaker', chargify, requests, threads)
+    print 'circuit %s' % breaker.state('/subscriptions/1.xml')
+
+    # Requests made while the half-open probe is in flight still fail fast
+    delay.value = 0
+    time.sleep(breaker.reset_timeout)
+    run('half-open, breaker', chargify, requests, threads)
+    print 'circuit %s' % breaker.state('/subscriptions/1.xml')
+    run('recovered, breaker', chargify, requests, threads)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:5]])
@@ -0,0 +1,185 @@
+'''
+Compares the HTTP/2 transport against the HTTP/1.1 connection pool under
+concurrent fan-out. Both talk plain text to local stand-in servers, run in
+their own processes, that answer every request with a small listing after
+a fixed delay, so the numbers reflect connection handling rather than
+Chargify. Requires the h2 package.
+
+    python benchmarks/http2.py [requests] [threads] [delay_ms]
+'''
+
+import BaseHTTPServer
+import SocketServer
+import httplib
+import multiprocessing
+import os
+import socket
+import sys
+import threading
+import time
+
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import h2.config
+import h2.connection
+import h2.events
+
+from pychargify.api import Chargify, ChargifyConnectionPool
+from pychargify.http2 import ChargifyHTTP2Transport
+
+BODY = '<?xml version="1.0" encoding="UTF-8"?><products type="array">%s' \
+    '</products>' % ''.join('<product><id>%d</id><handle>plan-%d</handle>'
+        '<price_in_cents type="integer">1000</price_in_cents></product>' %
+        (i, i) for i in range(5))
+
+
+class HTTP1Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    delay = 0
+
+    def do_GET(self):
+        time.sleep(self.delay)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    def log_message(self, *args):
+        pass
+
+
+class HTTP1Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class H2Server(object):
+    """
+    Prior knowledge (h2c) server answering each stream after the delay
+    without blocking the other streams on the connection
+    """
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(64)
+        self.port = self.sock.getsockname()[1]
+
+    def serve_forever(self):
+        while True:
+            client, address = self.sock.accept()
+            thread = threading.Thread(target=self.handle, args=(client,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, sock):
+        conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False))
+        lock = threading.Lock()
+        conn.initiate_connection()
+        sock.sendall(conn.data_to_send())
+
+        def respond(stream_id):
+            time.sleep(self.delay)
+            with lock:
+                conn.send_headers(stream_id, [(':status', '200'),
+                    ('content-length', str(len(BODY)))])
+                offset = 0
+                while offset < len(BODY):
+                    size = min(conn.local_flow_control_window(stream_id),
+                        conn.max_outbound_frame_size)
+                    if size <= 0:
+                        break
+                    chunk = BODY[offset:offset + size]
+                    offset += len(chunk)
+                    conn.send_data(stream_id, chunk,
+                        end_stream=offset >= len(BODY))
+                sock.sendall(conn.data_to_send())
+
+        while True:
+            data = sock.recv(65535)
+            if not data:
+                return
+            with lock:
+                events = conn.receive_data(data)
+                sock.sendall(conn.data_to_send())
+            for event in events:
+                if isinstance(event, h2.events.RequestReceived):
+                    thread = threading.Thread(target=respond,
+                        args=(event.stream_id,))
+                    thread.daemon = True
+                    thread.start()
+
+
+class CountingHTTP2Transport(ChargifyHTTP2Transport):
+
+    connections = 0
+
+    def _connect(self):
+        self.connections += 1
+        ChargifyHTTP2Transport._connect(self)
+
+
+class PlainPool(ChargifyConnectionPool):
+
+    def __init__(self, host, port, maxsize):
+        ChargifyConnectionPool.__init__(self, host, maxsize)
+        self.port = port
+        self.connections = 0
+
+    def _new_connection(self):
+        self.connections += 1
+        return httplib.HTTPConnection(self.host, self.port)
+
+
+def serve(kind, delay, ports):
+    if kind == 'h2':
+        server = H2Server(delay)
+        ports.put(server.port)
+    else:
+        HTTP1Handler.delay = delay
+        server = HTTP1Server(('127.0.0.1', 0), HTTP1Handler)
+        ports.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start(kind, delay):
+    """
+    Run a stand-in server in a child process and return its port
+    """
+    ports = multiprocessing.Queue()
+    process = multiprocessing.Process(target=serve, args=(kind, delay, ports))
+    process.daemon = True
+    process.start()
+    return ports.get()
+
+
+def run(label, transport, requests, threads, sockets):
+    chargify = Chargify('key', 'subdomain', transport=transport)
+    pool = ThreadPool(threads)
+    start_time = time.time()
+    pool.map(lambda i: chargify.Products.getAll(), range(requests))
+    elapsed = time.time() - start_time
+    pool.close()
+    print '%-10s %6d requests  %7.2fs  %8.1f req/s  %3d sockets' % (label,
+        requests, elapsed, requests / elapsed, sockets())
+
+
+def main(requests=1000, threads=20, delay_ms=20):
+    delay = delay_ms / 1000.0
+    http1_port = start('http1', delay)
+    h2_port = start('h2', delay)
+
+    for size in (4, threads):
+        pool = PlainPool('127.0.0.1', http1_port, size)
+        run('http/1.1', pool, requests, threads, lambda: pool.connections)
+    transport = CountingHTTP2Transport('127.0.0.1', h2_port, secure=False)
+    run('http/2', transport, requests, threads, lambda: transport.connections)
+    transport.close()
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:4]])
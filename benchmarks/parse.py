@@ -0,0 +1,93 @@
+'''
+Compares parsing a large subscription listing in-process against parsing
+it in a ChargifyParserPool with increasing numbers of worker processes.
+Alongside each parse a ticker thread counts how often it gets to run,
+showing how much the parse stalls other threads of the process.
+
+    python benchmarks/parse.py [subscriptions] [max_processes]
+'''
+
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pychargify.api import Chargify
+from pychargify.fake import ChargifyFakeBackend
+from pychargify.parallel import ChargifyParserPool
+
+
+class Listing(object):
+
+    def __init__(self, body):
+        self.body = body
+
+    def request(self, method, url, body=None, headers=None):
+        return 200, 'OK', self.body
+
+
+def listing(count):
+    fake = ChargifyFakeBackend()
+    family = fake.addProductFamily(name='Plans', handle='plans')
+    product = fake.addProduct(family, name='Basic', handle='basic',
+        price_in_cents=1000)
+    for i in range(count):
+        customer = fake.addCustomer(first_name='John', last_name='Doe',
+            email='john%d@example.com' % i, reference='ref-%d' % i)
+        fake.addSubscription(customer, product)
+    # The fake pages at 200 records, join the pages into one listing
+    pages = [fake.request('GET', '/subscriptions.xml?per_page=200&page=%d' %
+        page)[2] for page in range(1, count / 200 + 2)]
+    records = ''.join(page[page.index('>', page.index('<subscriptions')) + 1:
+        page.rindex('</subscriptions>')] for page in pages)
+    return '<?xml version="1.0" encoding="UTF-8"?><subscriptions ' \
+        'type="array">%s</subscriptions>' % records
+
+
+def run(label, chargify):
+    ticks = [0]
+    done = threading.Event()
+
+    def ticker():
+        while not done.is_set():
+            ticks[0] += 1
+            time.sleep(0.001)
+
+    thread = threading.Thread(target=ticker)
+    thread.start()
+    start = time.time()
+    subscriptions = chargify.Subscriptions.getAll()
+    elapsed = time.time() - start
+    done.set()
+    thread.join()
+    print '%-14s %6d records  %7.2fs  %8.0f records/s  ticker %5.0f/s' % (
+        label, len(subscriptions), elapsed, len(subscriptions) / elapsed,
+        ticks[0] / elapsed)
+
+
+def main(count=20000, max_processes=None):
+    max_processes = max_processes or multiprocessing.cpu_count()
+    transport = Listing(listing(count))
+    print '%d cores, %.1f MB listing' % (multiprocessing.cpu_count(),
+        len(transport.body) / 1048576.0)
+
+    run('in-process', Chargify('key', 'subdomain', transport=transport))
+    processes = 1
+    while processes <= max_processes:
+        parser = ChargifyParserPool(processes, min_size=0)
+        chargify = Chargify('key', 'subdomain', transport=transport,
+            parser=parser)
+        # Start the workers outside the measurement
+        parser.records('<subscriptions/>', 'ChargifySubscription',
+            'subscription')
+        parser._get_pool()
+        run('%d processes' % processes, chargify)
+        parser.close()
+        processes *= 2
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:3]])
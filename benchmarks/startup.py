@@ -0,0 +1,50 @@
+'''
+Measures the cost of importing pychargify.api and of the first request
+made after import, in fresh interpreters so every run starts cold. The
+first request goes through an in-process transport, so it measures the
+lazy imports and the XML parse path rather than the network.
+
+    python benchmarks/startup.py [runs]
+'''
+
+import os
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r'''
+import time
+start = time.time()
+import pychargify.api as api
+imported = time.time()
+
+class Transport(object):
+    def request(self, method, url, body=None, headers=None):
+        return 200, 'OK', ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<customer><id>1</id><first_name>John</first_name>'
+            '<created_at type="datetime">2011-01-01T00:00:00Z</created_at>'
+            '</customer>')
+
+chargify = api.Chargify('key', 'subdomain', transport=Transport())
+chargify.Customers.getById(1)
+print '%f %f' % (imported - start, time.time() - imported)
+'''
+
+
+def run_once():
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    output = subprocess.check_output([sys.executable, '-c', CHILD], env=env)
+    return [float(v) for v in output.split()]
+
+
+def main(runs=20):
+    results = [run_once() for i in range(runs)]
+    for i, label in enumerate(['import', 'first request']):
+        values = sorted(r[i] * 1000 for r in results)
+        print '%-14s median %7.2fms  min %7.2fms  max %7.2fms' % (
+            label, values[len(values) / 2], values[0], values[-1])
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
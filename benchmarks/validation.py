@@ -0,0 +1,84 @@
+'''
+Measures the throughput of bulk credit card and customer validation on
+generated records, about a tenth of them invalid, with the numpy batch
+checks and with the pure Python fallback.
+
+    python benchmarks/validation.py [records]
+'''
+
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pychargify import validation
+
+TODAY = datetime.date(2012, 6, 1)
+
+
+def card_number(rng):
+    digits = [4] + [rng.randint(0, 9) for i in range(14)]
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        if i % 2 == 0:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return ''.join(map(str, digits)) + str((10 - total % 10) % 10)
+
+
+def records(count, seed=1):
+    rng = random.Random(seed)
+    cards = []
+    customers = []
+    for i in xrange(count):
+        card = {
+            'full_number': card_number(rng),
+            'expiration_month': str(rng.randint(1, 12)),
+            'expiration_year': str(rng.randint(2012, 2020)),
+            'billing_country': 'US',
+            'billing_state': 'NY',
+        }
+        customer = {
+            'first_name': 'John',
+            'last_name': 'Doe',
+            'email': 'john%d@example.com' % i,
+            'country': 'CA',
+            'state': 'ON',
+        }
+        if i % 10 == 0:
+            card['full_number'] = card['full_number'][:-1] + \
+                str((int(card['full_number'][-1]) + 1) % 10)
+            customer['email'] = 'john%d.example.com' % i
+        cards.append(card)
+        customers.append(customer)
+    return cards, customers
+
+
+def run(label, cards, customers):
+    start = time.time()
+    card_result = validation.validateCreditCards(cards, TODAY)
+    cards_elapsed = time.time() - start
+    start = time.time()
+    customer_result = validation.validateCustomers(customers)
+    customers_elapsed = time.time() - start
+    print '%-8s cards %9.0f/s  %6d rejected   customers %9.0f/s  %6d ' \
+        'rejected' % (label, len(cards) / cards_elapsed,
+        len(card_result.rejected()), len(customers) / customers_elapsed,
+        len(customer_result.rejected()))
+
+
+def main(count=100000):
+    cards, customers = records(count)
+    if validation.numpy is not None:
+        run('numpy', cards, customers)
+    validation.numpy = None
+    run('python', cards, customers)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:2]])
@@ -0,0 +1,418 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Columnar revenue and balance reporting over subscription listings.
+
+Subscriptions are streamed straight from the listing XML into integer
+cent columns without building ChargifySubscription objects:
+
+    columns = ChargifySubscriptionColumns.fromListing(chargify.Subscriptions)
+    columns.sumBy('balance_in_cents', 'state')
+    columns.mrrByProduct()
+
+Columns are array.array instances, or numpy arrays from asarray() when
+numpy is installed, in which case the aggregations are vectorized.
+
+Metered component usage is summed per component and period the same way,
+fetching the usage listings of many subscriptions concurrently:
+
+    totals = ChargifyUsageTotals.fromSubscriptions(chargify.Subscriptions,
+        subscription_ids, period='month')
+    totals.totals    # {(component_id, '2011-01'): quantity}
+'''
+
+import threading
+
+from array import array
+from cStringIO import StringIO
+from itertools import izip
+from multiprocessing.pool import ThreadPool
+from xml.etree import cElementTree
+
+from api import bind_deadline, deadline_get, deadline_iter
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Average days per month, used to normalize daily intervals to monthly
+DAYS_PER_MONTH = 365.25 / 12
+
+
+class ChargifyCategories(object):
+    """
+    Interns repeated strings (states, product handles) as small integer
+    codes
+    @license    GNU General Public License
+    """
+
+    def __init__(self):
+        self.labels = []
+        self._codes = {}
+
+    def code(self, label):
+        code = self._codes.get(label)
+        if code is None:
+            code = self._codes[label] = len(self.labels)
+            self.labels.append(label)
+        return code
+
+    def __len__(self):
+        return len(self.labels)
+
+
+def _int(text):
+    if not text:
+        return 0
+    return int(text)
+
+
+def _number(text):
+    """
+    Usage quantities are integers, or decimals for some components
+    """
+    try:
+        return _int(text)
+    except ValueError:
+        return float(text)
+
+
+class ChargifySubscriptionColumns(object):
+    """
+    Column store of subscription prices, balances, states and intervals
+    @license    GNU General Public License
+    """
+
+    category_columns = ('state', 'product_handle', 'interval_unit')
+
+    def __init__(self):
+        self.id = array('l')
+        self.balance_in_cents = array('l')
+        self.price_in_cents = array('l')
+        self.interval = array('l')
+        self.state = array('l')
+        self.product_handle = array('l')
+        self.interval_unit = array('l')
+        self.categories = dict((name, ChargifyCategories())
+            for name in self.category_columns)
+
+    def __len__(self):
+        return len(self.id)
+
+    def feed(self, source):
+        """
+        Append the subscriptions of one listing response, a string or a
+        file like object, parsing it incrementally
+        """
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        if isinstance(source, str):
+            source = StringIO(source)
+
+        state = self.categories['state'].code
+        handle = self.categories['product_handle'].code
+        unit = self.categories['interval_unit'].code
+        count = 0
+
+        context = cElementTree.iterparse(source, events=('start', 'end'))
+        event, root = context.next()
+        for event, elem in context:
+            if event != 'end' or elem.tag != 'subscription':
+                continue
+            self.id.append(_int(elem.findtext('id')))
+            self.balance_in_cents.append(
+                _int(elem.findtext('balance_in_cents')))
+            self.state.append(state(elem.findtext('state') or ''))
+            self.price_in_cents.append(
+                _int(elem.findtext('product/price_in_cents')))
+            self.interval.append(_int(elem.findtext('product/interval')))
+            self.interval_unit.append(
+                unit(elem.findtext('product/interval_unit') or ''))
+            self.product_handle.append(
+                handle(elem.findtext('product/handle') or ''))
+            count += 1
+            # Drop the parsed record so memory stays flat
+            root.clear()
+        return count
+
+    @classmethod
+    def fromListing(cls, resource, per_page=200):
+        """
+        Page through a ChargifySubscription listing into a new column store,
+        parsing each page while it is still being received
+        """
+        columns = cls()
+        page = 1
+        while True:
+            body = resource._stream('/%s.xml?page=%d&per_page=%d' % (
+                resource.Meta.listing, page, per_page))
+            try:
+                count = columns.feed(body)
+            finally:
+                body.close()
+            if count < per_page:
+                return columns
+            page += 1
+
+    def asarray(self, name):
+        """
+        Return a column as a numpy array when numpy is available
+        """
+        column = getattr(self, name)
+        if numpy is None:
+            return column
+        if not column:
+            return numpy.zeros(0, dtype=numpy.dtype(column.typecode))
+        return numpy.frombuffer(column, dtype=numpy.dtype(column.typecode))
+
+    def _group_sum(self, values, codes, size):
+        if numpy is not None:
+            return numpy.bincount(codes, weights=values, minlength=size)
+        totals = [0] * size
+        for code, value in izip(codes, values):
+            totals[code] += value
+        return totals
+
+    def sumBy(self, value, key, where=None):
+        """
+        Sum an integer column grouped by a categorical column, e.g.
+        sumBy('balance_in_cents', 'state'). where optionally restricts the
+        rows to the given labels of the key column.
+        """
+        labels = self.categories[key].labels
+        totals = self._group_sum(self.asarray(value), self.asarray(key),
+            len(labels))
+        return dict((label, int(round(totals[i])))
+            for i, label in enumerate(labels)
+            if where is None or label in where)
+
+    def monthlyPriceInCents(self):
+        """
+        Each subscription's product price normalized to one month
+        """
+        units = self.categories['interval_unit'].labels
+        if numpy is not None:
+            interval = self.asarray('interval').astype(numpy.float64)
+            interval[interval == 0] = 1
+            per_unit = numpy.array([self._months_per_unit(u) for u in units]
+                or [1.0])
+            months = interval * per_unit[self.asarray('interval_unit')]
+            return self.asarray('price_in_cents') / months
+        factors = [self._months_per_unit(u) for u in units]
+        return array('d', [price / ((interval or 1) * factors[unit])
+            for price, interval, unit in izip(self.price_in_cents,
+                self.interval, self.interval_unit)])
+
+    def _months_per_unit(self, unit):
+        if unit == 'day':
+            return 1 / DAYS_PER_MONTH
+        return 1.0
+
+    def _active_mask(self, states):
+        codes = set(i for i, label in enumerate(self.categories['state'].labels)
+            if label in states)
+        if numpy is not None:
+            return numpy.in1d(self.asarray('state'), list(codes))
+        return [code in codes for code in self.state]
+
+    def mrr(self, states=('active', 'past_due')):
+        """
+        Total monthly recurring revenue in cents of subscriptions in states
+        """
+        monthly = self.monthlyPriceInCents()
+        mask = self._active_mask(states)
+        if numpy is not None:
+            return float(monthly[mask].sum())
+        return sum(m for m, keep in izip(monthly, mask) if keep)
+
+    def mrrByProduct(self, states=('active', 'past_due')):
+        """
+        Monthly recurring revenue in cents grouped by product handle
+        """
+        labels = self.categories['product_handle'].labels
+        monthly = self.monthlyPriceInCents()
+        mask = self._active_mask(states)
+        handles = self.asarray('product_handle')
+        if numpy is not None:
+            totals = numpy.bincount(handles[mask], weights=monthly[mask],
+                minlength=len(labels))
+        else:
+            totals = [0.0] * len(labels)
+            for code, value, keep in izip(handles, monthly, mask):
+                if keep:
+                    totals[code] += value
+        return dict((label, float(totals[i])) for i, label in enumerate(labels))
+
+
+# Characters of an ISO 8601 timestamp that make up each period
+PERIODS = {'year': 4, 'month': 7, 'day': 10, None: 0}
+
+
+class ChargifyUsageTotals(object):
+    """
+    Metered usage quantities summed per (component id, period), where a
+    period is the prefix of the usage's created_at naming its year, month
+    or day ('2011-01' by month) in the time zone Chargify reports, or ''
+    when period is None. Usage records are summed while the listing is
+    parsed and never kept.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, period='month'):
+        if period not in PERIODS:
+            raise ValueError('period must be one of %s' %
+                ', '.join(repr(p) for p in PERIODS))
+        self.period = period
+        self.totals = {}
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.totals)
+
+    def feed(self, source, component_id):
+        """
+        Add the usages of one listing response of component_id, a string
+        or a file like object, and return the number of usages read
+        """
+        if isinstance(source, unicode):
+            source = source.encode('utf-8')
+        if isinstance(source, str):
+            source = StringIO(source)
+
+        width = PERIODS[self.period]
+        totals = {}
+        counts = {}
+        count = 0
+
+        context = cElementTree.iterparse(source, events=('start', 'end'))
+        event, root = context.next()
+        for event, elem in context:
+            if event != 'end' or elem.tag != 'usage':
+                continue
+            key = (component_id, (elem.findtext('created_at') or '')[:width])
+            totals[key] = totals.get(key, 0) + \
+                _number(elem.findtext('quantity'))
+            counts[key] = counts.get(key, 0) + 1
+            count += 1
+            root.clear()
+
+        self.merge(totals, counts)
+        return count
+
+    def merge(self, totals, counts=None):
+        """
+        Add totals (and usage counts) keyed by (component id, period)
+        """
+        self._lock.acquire()
+        try:
+            for key, quantity in totals.iteritems():
+                self.totals[key] = self.totals.get(key, 0) + quantity
+            for key, count in (counts or {}).iteritems():
+                self.counts[key] = self.counts.get(key, 0) + count
+        finally:
+            self._lock.release()
+
+    def byComponent(self):
+        """
+        Quantities per component id across all periods
+        """
+        result = {}
+        for (component_id, period), quantity in self.totals.iteritems():
+            result[component_id] = result.get(component_id, 0) + quantity
+        return result
+
+    def byPeriod(self):
+        """
+        Quantities per period across all components
+        """
+        result = {}
+        for (component_id, period), quantity in self.totals.iteritems():
+            result[period] = result.get(period, 0) + quantity
+        return result
+
+    def rows(self):
+        """
+        (component id, period, quantity, usage count) tuples, sorted
+        """
+        return [key + (quantity, self.counts.get(key, 0))
+            for key, quantity in sorted(self.totals.iteritems())]
+
+    def _fetch(self, resource, subscription_id, component_id, per_page):
+        """
+        Page through the usages of one subscription component
+        """
+        page = 1
+        while True:
+            body = resource._stream(
+                '/subscriptions/%s/components/%s/usages.xml?page=%d&per_page=%d'
+                % (subscription_id, component_id, page, per_page))
+            try:
+                count = self.feed(body, component_id)
+            finally:
+                body.close()
+            if count < per_page:
+                return
+            page += 1
+
+    @staticmethod
+    def _metered_components(resource, subscription_id):
+        body = resource._stream('/subscriptions/%s/components.xml' %
+            subscription_id)
+        try:
+            ids = []
+            for event, elem in cElementTree.iterparse(body):
+                if elem.tag == 'component':
+                    if elem.findtext('kind') == 'metered_component':
+                        ids.append(int(elem.findtext('component_id')))
+                    elem.clear()
+            return ids
+        finally:
+            body.close()
+
+    @classmethod
+    def fromSubscriptions(cls, resource, subscription_ids, component_ids=None,
+                          period='month', workers=8, per_page=200):
+        """
+        Sum the usages of many subscriptions, fetching up to workers
+        listings at once through the session of resource. Without
+        component_ids each subscription's metered components are looked up
+        first, and their usage listings are queued as each lookup returns.
+        Under a ChargifyDeadline, listings not yet fetched when it passes
+        are abandoned.
+        """
+        totals = cls(period)
+        pool = ThreadPool(workers)
+        try:
+            if component_ids is not None:
+                pairs = [(s, c) for s in subscription_ids
+                    for c in component_ids]
+            else:
+                lookup = bind_deadline(lambda s: [(s, c) for c in
+                    cls._metered_components(resource, s)])
+                pairs = (pair for found in deadline_iter(
+                    pool.imap_unordered(lookup, subscription_ids))
+                    for pair in found)
+            fetch = bind_deadline(lambda pair: totals._fetch(resource,
+                pair[0], pair[1], per_page))
+            results = [pool.apply_async(fetch, (pair,)) for pair in pairs]
+            for result in results:
+                deadline_get(result)
+        finally:
+            pool.terminate()
+        return totals
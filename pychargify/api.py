@@ -19,32 +19,57 @@ Created on Nov 20, 2009
 Author: Paul Trippett (paul@pyhub.com)
 '''
 
-import httplib
 import base64
+import sys
+import threading
 import time
+import types
 import datetime
 import iso8601
-import inspect
 import logging
 
-from itertools import chain
-from xml.dom import minidom
-
 log = logging.getLogger("pychargify")
 
 
-try:
-    import json
-except Exception, e:
-    try:
-        import simplejson as json
-    except Exception, e:
-        try:
-            # For AppEngine users
-            import django.utils.simplejson as json
-        except Exception, e:
-            log.error("No Json library found... Exiting.")
-            exit()
+class LazyModule(object):
+    """
+    Stands in for a module and imports it on first attribute access, so
+    importing pychargify does not pay for the transport, XML and JSON
+    libraries until they are needed. The first of several alternative
+    module names that imports successfully is used.
+    """
+
+    def __init__(self, *names):
+        self._names = names
+        self._module = None
+
+    def _load(self):
+        for name in self._names:
+            try:
+                __import__(name)
+            except ImportError:
+                continue
+            self._module = sys.modules[name]
+            return self._module
+        raise ChargifyError('None of %s could be imported' %
+            ', '.join(self._names))
+
+    def __getattr__(self, attr):
+        return getattr(self._module or self._load(), attr)
+
+
+httplib = LazyModule('httplib')
+socket = LazyModule('socket')
+urllib = LazyModule('urllib')
+zlib = LazyModule('zlib')
+cStringIO = LazyModule('cStringIO')
+minidom = LazyModule('xml.dom.minidom')
+expat = LazyModule('xml.parsers.expat')
+decimal = LazyModule('decimal')
+hashlib = LazyModule('hashlib')
+multiprocessing = LazyModule('multiprocessing')
+# django.utils.simplejson for AppEngine users
+json = LazyModule('json', 'simplejson', 'django.utils.simplejson')
 
 
 class ChargifyError(Exception):
@@ -97,78 +122,957 @@ class ChargifyServerError(ChargifyError):
     pass
 
 
+class ChargifyDeadlineExceeded(ChargifyError):
+    """
+    The time budget of the current ChargifyDeadline ran out
+    @license    GNU General Public License
+    """
+    pass
+
+
+_deadlines = threading.local()
+
+# A request failing this close to its deadline is taken to have been cut
+# short by it, socket timeouts may fire a little before the wall clock
+# reaches the deadline
+DEADLINE_SLACK = 0.01
+
+
+class ChargifyDeadline(object):
+    """
+    A time budget shared by every request made while it is active:
+
+        with chargify.deadline(0.5):
+            subscription = chargify.Subscriptions.getBySubscriptionId(id)
+            components = subscription.getComponents()
+
+    Connecting, reading, retries and parsing each get at most the time
+    left, and raise ChargifyDeadlineExceeded once none is. Deadlines nest,
+    an inner one never outlasting the one around it. They are per thread;
+    bind() carries one over to a worker thread.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, timeout, clock=time.time):
+        self.clock = clock
+        self.expires = clock() + timeout
+
+    def remaining(self):
+        """
+        Seconds left, raising ChargifyDeadlineExceeded when there are none
+        """
+        remaining = self.expires - self.clock()
+        if remaining <= 0:
+            raise ChargifyDeadlineExceeded('Deadline exceeded by %.3fs' %
+                -remaining)
+        return remaining
+
+    def __enter__(self):
+        stack = _deadlines.__dict__.setdefault('stack', [])
+        if stack and stack[-1].expires < self.expires:
+            stack.append(stack[-1])
+        else:
+            stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _deadlines.stack.pop()
+
+    def bind(self, function):
+        """
+        Wrap function to run under this deadline in whichever thread
+        calls it
+        """
+        def bound(*args, **kwargs):
+            self.__enter__()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.__exit__(None, None, None)
+        return bound
+
+
+def current_deadline():
+    """
+    The deadline in effect in the calling thread, or None
+    """
+    stack = getattr(_deadlines, 'stack', None)
+    if stack:
+        return stack[-1]
+    return None
+
+
+def deadline_passed():
+    """
+    Whether the deadline in effect in the calling thread has run out, give
+    or take DEADLINE_SLACK
+    """
+    deadline = current_deadline()
+    return deadline is not None and \
+        deadline.expires - deadline.clock() <= DEADLINE_SLACK
+
+
+def deadline_timeout(timeout=None):
+    """
+    Cap a timeout in seconds, None meaning none, at the time left before
+    the current deadline, raising ChargifyDeadlineExceeded when it passed
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return timeout
+    remaining = deadline.remaining()
+    if timeout is None:
+        return remaining
+    return min(timeout, remaining)
+
+
+def bind_deadline(function):
+    """
+    Wrap function to run under the calling thread's deadline, if any, for
+    handing to a worker thread
+    """
+    deadline = current_deadline()
+    if deadline is None:
+        return function
+    return deadline.bind(function)
+
+
+def deadline_get(result):
+    """
+    Wait for a multiprocessing AsyncResult until the current deadline
+    """
+    try:
+        return result.get(deadline_timeout())
+    except multiprocessing.TimeoutError:
+        raise ChargifyDeadlineExceeded('Deadline exceeded waiting for '
+            'a worker')
+
+
+def deadline_iter(iterator):
+    """
+    Iterate over the results of a multiprocessing imap until the current
+    deadline
+    """
+    while True:
+        try:
+            yield iterator.next(deadline_timeout())
+        except StopIteration:
+            return
+        except multiprocessing.TimeoutError:
+            raise ChargifyDeadlineExceeded('Deadline exceeded waiting for '
+                'a worker')
+
+
+class ChargifyDecodingReader(object):
+    """
+    A file like view of a response body that undoes a gzip or deflate
+    Content-Encoding chunk by chunk as it is read, so compressed listings
+    can be fed to a parser without first being buffered whole
+    @license    GNU General Public License
+    """
+    chunk_size = 16384
+
+    def __init__(self, fp, encoding=None, release=None):
+        self.fp = fp
+        self.release = release
+        encoding = (encoding or '').strip().lower()
+        if encoding in ('gzip', 'x-gzip', 'deflate'):
+            # 32 + MAX_WBITS accepts both gzip and zlib headers
+            self._decoder = zlib.decompressobj(32 + zlib.MAX_WBITS)
+        else:
+            self._decoder = None
+        # Some servers send deflate without the zlib header
+        self._raw_fallback = encoding == 'deflate'
+        self._buffer = ''
+        self._eof = False
+
+    def _decode(self, chunk):
+        try:
+            return self._decoder.decompress(chunk)
+        except zlib.error:
+            if not self._raw_fallback:
+                raise
+            self._raw_fallback = False
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decoder.decompress(chunk)
+
+    def _fill(self):
+        """
+        Decode the next chunk into the buffer, returns False at the end
+        """
+        chunk = self.fp.read(self.chunk_size)
+        if not chunk:
+            self._buffer += self._decoder.flush()
+            self._finish(True)
+            return False
+        self._buffer += self._decode(chunk)
+        self._raw_fallback = False
+        return True
+
+    def _finish(self, complete):
+        if not self._eof:
+            self._eof = True
+            if self.release is not None:
+                self.release(complete)
+
+    def read(self, size=-1):
+        if self._decoder is None:
+            data = self.fp.read() if size < 0 else self.fp.read(size)
+            if size < 0 or not data:
+                self._finish(True)
+            return data
+
+        if size < 0:
+            parts = [self._buffer]
+            self._buffer = ''
+            while not self._eof and self._fill():
+                parts.append(self._buffer)
+                self._buffer = ''
+            parts.append(self._buffer)
+            self._buffer = ''
+            return ''.join(parts)
+
+        while len(self._buffer) < size and not self._eof and self._fill():
+            pass
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+    def close(self):
+        self._finish(False)
+
+
+def decode_body(data, encoding):
+    """
+    Undo the Content-Encoding of a complete response body
+    """
+    if not encoding:
+        return data
+    return ChargifyDecodingReader(cStringIO.StringIO(data), encoding).read()
+
+
+def gzip_body(data):
+    """
+    Gzip a request body
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class ChargifyTransport(object):
+    """
+    Moves a request to Chargify and its response back. ChargifySession
+    sends every request through one; replace it to run against something
+    other than the live API, see pychargify.fake and pychargify.replay.
+    @license    GNU General Public License
+    """
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Send a request and return a (status, reason, body) tuple
+        """
+        raise NotImplementedError()
+
+    def stream(self, method, url, body=None, headers=None):
+        """
+        Send a request and return a (status, reason, file) tuple whose
+        body can be read incrementally
+        """
+        status, reason, data = self.request(method, url, body, headers)
+        return status, reason, cStringIO.StringIO(data)
+
+    def close(self):
+        pass
+
+
+class _DeadlineSocket(object):
+    """
+    Wraps the socket of a pooled connection so that, while a
+    ChargifyDeadline is active, every receive waits no longer than the
+    time left. A response body sent slowly is then cut off at the
+    deadline rather than only each wait for its next packet.
+    """
+
+    def __init__(self, sock, read_timeout):
+        self._sock = sock
+        self.read_timeout = read_timeout
+
+    def recv(self, size, *args):
+        if current_deadline() is not None:
+            self._sock.settimeout(deadline_timeout(self.read_timeout))
+        return self._sock.recv(size, *args)
+
+    def makefile(self, mode='r', bufsize=-1):
+        # Reads from the response go through recv above
+        return socket._fileobject(self, mode, bufsize)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
+
+
+# Requests safe to resend when a connection drops before the response
+IDEMPOTENT_METHODS = ('GET', 'HEAD')
+
+
+class ChargifyConnectionPool(ChargifyTransport):
+    """
+    The default transport. Keeps idle keep-alive HTTPS connections to a
+    single Chargify host so consecutive requests do not pay for a new TCP
+    and TLS handshake. connect_timeout bounds opening a connection and
+    read_timeout each wait for the response, both in seconds; None waits
+    forever.
+
+    A request failing on a reused connection is retried once on a fresh
+    one when it never reached the server, and also when it did but is a
+    GET or HEAD. Writes that may have been processed are never resent.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, host, maxsize=4, connect_timeout=None,
+                 read_timeout=None):
+        self.host = host
+        self.maxsize = maxsize
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _new_connection(self):
+        if self.host is None:
+            raise ChargifyError('No Chargify site to connect to, give the '
+                'object an API key and subdomain or a session')
+        timeout = deadline_timeout(self.connect_timeout)
+        if timeout is None:
+            return httplib.HTTPSConnection(self.host)
+        return httplib.HTTPSConnection(self.host, timeout=timeout)
+
+    def _send_request(self, conn, method, url, body, headers):
+        if conn.sock is not None:
+            conn.sock.settimeout(deadline_timeout(self.read_timeout))
+        conn.request(method, url, body, headers or {})
+
+    def _get_response(self, conn):
+        if conn.sock is not None:
+            if not isinstance(conn.sock, _DeadlineSocket):
+                conn.sock = _DeadlineSocket(conn.sock, self.read_timeout)
+            conn.sock.settimeout(deadline_timeout(self.read_timeout))
+        return conn.getresponse()
+
+    def _exchange(self, conn, method, url, body, headers):
+        self._send_request(conn, method, url, body, headers)
+        return self._get_response(conn)
+
+    def _get_connection(self):
+        """
+        Returns an idle connection and whether it has been used before
+        """
+        self._lock.acquire()
+        try:
+            if self._idle:
+                return self._idle.pop(), True
+        finally:
+            self._lock.release()
+        return self._new_connection(), False
+
+    def _put_connection(self, conn):
+        self._lock.acquire()
+        try:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        finally:
+            self._lock.release()
+        conn.close()
+
+    def close(self):
+        """
+        Close every idle connection
+        """
+        self._lock.acquire()
+        try:
+            idle, self._idle = self._idle, []
+        finally:
+            self._lock.release()
+        for conn in idle:
+            conn.close()
+
+    def _send(self, method, url, body, headers):
+        """
+        Send a request and return the connection and its response
+        """
+        conn, reused = self._get_connection()
+        sent = False
+        try:
+            self._send_request(conn, method, url, body, headers)
+            sent = True
+            return conn, self._get_response(conn)
+        except socket.timeout:
+            # Chargify is slow rather than the connection stale, retrying
+            # would only double the wait
+            conn.close()
+            raise
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            # A write that was sent may have been processed before the
+            # connection dropped, resending it could create or charge twice
+            if not reused or (sent and method not in IDEMPOTENT_METHODS):
+                raise
+        # The server dropped an idle keep-alive connection, retry once
+        # on a fresh one, time permitting.
+        conn = self._new_connection()
+        try:
+            return conn, self._exchange(conn, method, url, body, headers)
+        except:
+            conn.close()
+            raise
+
+    def _reader(self, conn, response):
+        """
+        Wrap a response in a decoding reader that hands the connection
+        back to the pool once the body has been read to the end
+        """
+        def release(complete):
+            if complete and not response.will_close:
+                self._put_connection(conn)
+            else:
+                conn.close()
+        return ChargifyDecodingReader(response,
+            response.getheader('content-encoding'), release)
+
+    def request(self, method, url, body=None, headers=None):
+        """
+        Send a request and return a (status, reason, body) tuple
+        """
+        conn, response = self._send(method, url, body, headers)
+        reader = self._reader(conn, response)
+        try:
+            data = reader.read()
+        except:
+            reader.close()
+            raise
+        return response.status, response.reason, data
+
+    def stream(self, method, url, body=None, headers=None):
+        conn, response = self._send(method, url, body, headers)
+        return response.status, response.reason, self._reader(conn, response)
+
+
+class ChargifySession(object):
+    """
+    Holds the credentials, the precomputed authorization header, the
+    connection pool, the response cache, the circuit breaker and the
+    request hooks shared by every resource object of one Chargify site.
+    A session without a subdomain, such as the one of objects decoded from
+    webhooks, holds objects but cannot send requests over the default
+    transport.
+    @license    GNU General Public License
+    """
+    base_host = '.chargify.com'
+
+    def __init__(self, apikey, subdomain, cache=None, pool_size=4,
+                 transport=None, compress_min_size=None, connect_timeout=10,
+                 read_timeout=60, breaker=None, parser=None):
+        self.api_key = apikey
+        self.sub_domain = subdomain
+        self.request_host = subdomain + self.base_host if subdomain else None
+        self.auth_header = 'Basic %s' % base64.b64encode('%s:%s' % (
+            apikey or '', 'x'))
+        self.headers = {
+            'Authorization': self.auth_header,
+            'User-Agent': 'pychargify',
+            'Host': self.request_host,
+            'Accept': 'application/xml',
+            'Accept-Encoding': 'gzip, deflate',
+            'Content-Type': 'text/xml; charset="UTF-8"',
+        }
+        # Request bodies of at least this many bytes are sent gzipped,
+        # None sends every body as is
+        self.compress_min_size = compress_min_size
+        self.pool = ChargifyConnectionPool(self.request_host, pool_size,
+            connect_timeout, read_timeout)
+        self.transport = transport or self.pool
+        self.cache = cache
+        # A callable taking a URL, when set only the URLs it accepts are
+        # served from and stored in the cache. Caches may bring their own
+        # as cacheable.
+        self.cache_filter = getattr(cache, 'cacheable', None)
+        # Cache keys are scoped to the site and the API key, so sessions of
+        # different sites or credentials can share one cache
+        self.cache_prefix = '%s:%s:' % (self.request_host,
+            hashlib.sha1(apikey or '').hexdigest()[:16])
+        # See pychargify.breaker, None sends every request
+        self.breaker = breaker
+        # See pychargify.parallel, None parses every listing in-process
+        self.parser = parser
+        self.hooks = {'request': [], 'response': []}
+
+    def _fire(self, event, *args):
+        for hook in self.hooks.get(event, ()):
+            hook(*args)
+
+    def cacheKey(self, url):
+        """
+        The key the response to a GET of url is cached under
+        """
+        return self.cache_prefix + url
+
+    def request(self, method, url, data=None):
+        """
+        Send a request through the transport and return a (status, reason,
+        body) tuple. Successful GETs are served from and stored in the cache
+        when one is configured; writes drop the cached copy of their URL.
+        """
+        cache = self.cache
+        if cache is not None and self.cache_filter is not None and \
+                not self.cache_filter(url):
+            cache = None
+        if cache is not None:
+            key = self.cacheKey(url)
+            if method == 'GET':
+                body = cache.get(key)
+                if body is not None:
+                    return 200, 'OK', body
+            else:
+                cache.delete(key)
+
+        self._fire('request', method, url, data)
+        log.debug('Requesting to %s' % url)
+        data, headers = self._encode(data)
+        status, reason, body = self._send(url,
+            lambda: self.transport.request(method, url, data, headers))
+        self._fire('response', method, url, status, body)
+
+        if cache is not None and method == 'GET' and status == 200:
+            cache.set(key, body)
+        return status, reason, body
+
+    def _encode(self, data):
+        """
+        Compress a large request body, returning it with the headers to
+        send it with
+        """
+        if data and self.compress_min_size is not None and \
+                len(data) >= self.compress_min_size:
+            headers = dict(self.headers)
+            headers['Content-Encoding'] = 'gzip'
+            return gzip_body(data), headers
+        return data, self.headers
+
+    def stream(self, method, url, data=None):
+        """
+        Send a request bypassing the cache and return a (status, reason,
+        file) tuple whose body is decompressed as it is read
+        """
+        self._fire('request', method, url, data)
+        log.debug('Streaming %s' % url)
+        data, headers = self._encode(data)
+        return self._send(url,
+            lambda: self.transport.stream(method, url, data, headers))
+
+    def _send(self, url, send):
+        """
+        Call the transport through the circuit breaker, within the current
+        deadline
+        """
+        deadline_timeout()
+        try:
+            if self.breaker is not None:
+                return self.breaker.call(url, send)
+            return send()
+        except (socket.error, httplib.HTTPException):
+            if deadline_passed():
+                raise ChargifyDeadlineExceeded('Deadline exceeded waiting '
+                    'for %s' % url)
+            raise
+
+
+def _node_text(node):
+    """
+    Get the text value of an XML element
+    """
+    return ''.join(child.data for child in node.childNodes
+        if child.nodeType == child.TEXT_NODE)
+
+
+class ChargifyField(object):
+    """
+    Declares one field of a resource: its default, how its XML text is
+    decoded into a Python value and how a value is encoded back. Read only
+    fields are parsed but never sent.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, default=None, read_only=False):
+        self.default = default
+        self.read_only = read_only
+        self.name = None
+
+    def decode(self, text):
+        return text
+
+    def encode(self, value):
+        return unicode(value)
+
+    def fromNode(self, node):
+        """
+        Decode an element into a plain, picklable value
+        """
+        return self.decode(_node_text(node))
+
+    def toNode(self, dom, name, value, partial):
+        """
+        The element for value, or None to leave it out. partial asks
+        nested objects for their changed fields only.
+        """
+        node = minidom.Element(name)
+        node.appendChild(dom.createTextNode(self.encode(value)))
+        return node
+
+
+class ChargifyStringField(ChargifyField):
+    """
+    Text, sent with non-ascii characters as character references
+    @license    GNU General Public License
+    """
+
+    def __init__(self, default='', read_only=False):
+        ChargifyField.__init__(self, default, read_only)
+
+    def encode(self, value):
+        if not isinstance(value, basestring):
+            value = unicode(value)
+        return value.encode('ascii', 'xmlcharrefreplace')
+
+
+class ChargifyIntegerField(ChargifyField):
+    """
+    An integer; empty elements decode to None and the rare fractional
+    value to a Decimal
+    @license    GNU General Public License
+    """
+
+    def decode(self, text):
+        if not text:
+            return None
+        try:
+            return int(text)
+        except ValueError:
+            return decimal.Decimal(text)
+
+
+class ChargifyCentsField(ChargifyIntegerField):
+    """
+    An amount of money in cents
+    @license    GNU General Public License
+    """
+
+    def __init__(self, default=0, read_only=False):
+        ChargifyIntegerField.__init__(self, default, read_only)
+
+
+class ChargifyBooleanField(ChargifyField):
+    """
+    A boolean sent as true or false
+    @license    GNU General Public License
+    """
+
+    def decode(self, text):
+        if not text:
+            return None
+        return text.strip().lower() in ('true', '1')
+
+    def encode(self, value):
+        if isinstance(value, bool):
+            return value and 'true' or 'false'
+        return unicode(value)
+
+
+class ChargifyDateTimeField(ChargifyField):
+    """
+    A timestamp, decoded into a local naive datetime
+    @license    GNU General Public License
+    """
+
+    def decode(self, text):
+        if not text:
+            return None
+        return datetime.datetime.fromtimestamp(iso8601.parse(text))
+
+    def encode(self, value):
+        if isinstance(value, (datetime.datetime, datetime.date)):
+            return value.isoformat()
+        return unicode(value)
+
+
+class ChargifyNestedField(ChargifyField):
+    """
+    A resource embedded in another, named by class so that resources can
+    refer to ones declared further down the module
+    @license    GNU General Public License
+    """
+
+    def __init__(self, resource_name, default=None, read_only=False):
+        ChargifyField.__init__(self, default, read_only)
+        self.resource_name = resource_name
+        self._resource = None
+
+    @property
+    def resource(self):
+        if self._resource is None:
+            self._resource = ChargifyResourceType.resources[
+                self.resource_name]
+        return self._resource
+
+    def fromNode(self, node):
+        return self.resource._compactNode(node)
+
+    def build(self, value, session):
+        """
+        Turn the plain value from fromNode into resource objects
+        """
+        return self.resource._fromCompact(value, session)
+
+    def toNode(self, dom, name, value, partial):
+        return value._toxml(dom, value._changedFields() if partial else None)
+
+
+class ChargifyArrayField(ChargifyNestedField):
+    """
+    A list of embedded resources
+    @license    GNU General Public License
+    """
+
+    def fromNode(self, node):
+        resource = self.resource
+        return [resource._compactNode(child) for child in node.childNodes
+            if child.nodeType == child.ELEMENT_NODE]
+
+    def build(self, value, session):
+        resource = self.resource
+        return [resource._fromCompact(v, session) for v in value]
+
+    def toNode(self, dom, name, value, partial):
+        node = minidom.Element(name)
+        node.setAttribute('type', 'array')
+        for v in value:
+            if partial and not v.isDirty():
+                continue
+            child = v._toxml(dom, v._changedFields() if partial else None)
+            if child is not None:
+                node.appendChild(child)
+        return node
+
+
+# Fields for elements a resource does not declare, by their type attribute
+_TYPED_FIELDS = {
+    'integer': ChargifyIntegerField(),
+    'boolean': ChargifyBooleanField(),
+    'datetime': ChargifyDateTimeField(),
+}
+_STRING_FIELD = ChargifyStringField()
+
+# Fields for values assigned to undeclared attributes, by Python type
+_VALUE_FIELDS = {
+    bool: _TYPED_FIELDS['boolean'],
+    int: _TYPED_FIELDS['integer'],
+    long: _TYPED_FIELDS['integer'],
+    datetime.datetime: _TYPED_FIELDS['datetime'],
+    datetime.date: _TYPED_FIELDS['datetime'],
+    list: ChargifyArrayField(None),
+}
+_NESTED_FIELD = ChargifyNestedField(None)
+
+
+def _value_field(value):
+    field = _VALUE_FIELDS.get(type(value))
+    if field is not None:
+        return field
+    if isinstance(value, ChargifyBase):
+        return _NESTED_FIELD
+    return _STRING_FIELD
+
+
+class ChargifyResourceType(type):
+    """
+    Compiles the fields a resource class declares, together with those it
+    inherits, into its __fields__ table when the class is created, and
+    registers the class by name for nested fields to find. Each declared
+    attribute is replaced on the class by the field's default.
+    @license    GNU General Public License
+    """
+    resources = {}
+
+    def __init__(cls, name, bases, attrs):
+        super(ChargifyResourceType, cls).__init__(name, bases, attrs)
+        fields = {}
+        for base in reversed(cls.__mro__[1:]):
+            fields.update(base.__dict__.get('__fields__', {}))
+        for key, value in attrs.items():
+            if isinstance(value, ChargifyField):
+                value.name = key
+                fields[key] = value
+                setattr(cls, key, value.default)
+        cls.__fields__ = fields
+        cls.__nested__ = tuple(sorted(key for key, field in fields.iteritems()
+            if isinstance(field, ChargifyNestedField)))
+        cls.__attribute_types__ = dict((key, fields[key].resource_name)
+            for key in cls.__nested__)
+        ChargifyResourceType.resources[name] = cls
+
+
 class ChargifyBase(object):
     """
     The ChargifyBase class provides a common base for all classes
-    in this module
+    in this module. Resources declare their fields as ChargifyField
+    class attributes.
     @license    GNU General Public License
     """
+    __metaclass__ = ChargifyResourceType
 
     class Meta:
         listing = None
 
-    __ignore__ = ['api_key', 'sub_domain', 'base_host', 'request_host',
+    __ignore__ = ['session', 'api_key', 'sub_domain', 'base_host',
+                  'request_host', 'saved', '_dirty', '_loaded',
                   #FIXME: 'id',
-        '__xmlnodename__', 'Meta', 'created_at', 'modified_at',
-        'updated_at', 'getByReference']
+        '__xmlnodename__', 'Meta', 'getByReference']
 
-    api_key = ''
-    sub_domain = ''
-    base_host = '.chargify.com'
-    request_host = ''
+    session = None
+    _loaded = False
+
+    created_at = ChargifyDateTimeField(read_only=True)
+    modified_at = ChargifyDateTimeField(read_only=True)
+    updated_at = ChargifyDateTimeField(read_only=True)
 
-    def __init__(self, apikey, subdomain):
+    def __init__(self, apikey=None, subdomain=None, session=None):
         """
         Initialize the Class with the API Key and SubDomain for Requests
-        to the Chargify API
+        to the Chargify API, or with an existing ChargifySession
         """
-        self.api_key = apikey
-        self.sub_domain = subdomain
-        self.request_host = self.sub_domain + self.base_host
+        if session is None:
+            session = ChargifySession(apikey, subdomain)
+        self.session = session
+
+    @property
+    def api_key(self):
+        return self.session.api_key
+
+    @property
+    def sub_domain(self):
+        return self.session.sub_domain
+
+    @property
+    def request_host(self):
+        return self.session.request_host
 
     def __getstate__(self):
         result = self.__dict__.copy()
         map(lambda attr: result.pop(attr, None), self.__ignore__)
         return result
 
-    def __get_xml_value(self, nodelist):
+    def __setattr__(self, name, value):
+        self.__dict__[name] = value
+        self.__dict__.setdefault('_dirty', set()).add(name)
+
+    def _markClean(self, nested=True):
+        """
+        Record the current values as the ones known to the API, those of
+        nested objects too unless nested is False
+        """
+        self.__dict__['_dirty'] = set()
+        self.__dict__['_loaded'] = True
+        if not nested:
+            return
+        for name in self.__nested__:
+            value = self.__dict__.get(name)
+            if value is None:
+                continue
+            for child in (value if isinstance(value, list) else [value]):
+                if isinstance(child, ChargifyBase):
+                    child._markClean()
+
+    def _changedFields(self):
+        """
+        The fields changed since the object was loaded from the API,
+        including nested objects changed in place. None for objects that
+        were never loaded, which have to be sent whole.
+        """
+        if not self._loaded:
+            return None
+        fields = set(self.__dict__.get('_dirty', ()))
+        for name in self.__nested__:
+            value = self.__dict__.get(name)
+            if name in fields or value is None:
+                continue
+            for nested in (value if isinstance(value, list) else [value]):
+                if isinstance(nested, ChargifyBase) and \
+                        nested._changedFields() != []:
+                    fields.add(name)
+                    break
+        return sorted(fields)
+
+    def isDirty(self):
+        return self._changedFields() != []
+
+    def freeze(self):
+        """
+        Return an immutable, hashable ChargifyFrozen snapshot of the object
+        that can be shared between threads and caches without copying
+        """
+        return ChargifyFrozen(self)
+
+    @classmethod
+    def _compactNode(cls, node):
         """
-        Get the Text Value from an XML Node
+        Decode an XML element of this class into a dictionary of plain
+        values, nested resources as dictionaries of their own. Compact
+        records need no session and can be pickled.
         """
-        rc = ""
-        for node in nodelist:
-            if node.nodeType == node.TEXT_NODE:
-                rc = rc + node.data
-        return rc
+        values = {}
+        fields = cls.__fields__
+        for child in node.childNodes:
+            if child.nodeType != child.ELEMENT_NODE:
+                continue
+            name = child.nodeName
+            field = fields.get(name)
+            if field is None:
+                field = _TYPED_FIELDS.get(child.getAttribute('type'),
+                    _STRING_FIELD)
+            values[name] = field.fromNode(child)
+        return values
+
+    @classmethod
+    def _fromCompact(cls, values, session):
+        """
+        Build a new object of this class from a compact record
+        """
+        obj = cls(session=session)
+        fields = cls.__fields__
+        for name in cls.__nested__:
+            value = values.get(name)
+            if value is not None:
+                values[name] = fields[name].build(value, session)
+        obj.__dict__.update(values)
+        obj._markClean()
+        return obj
+
+    @classmethod
+    def _fromNode(cls, node, session):
+        """
+        Build a new object of this class from its XML element
+        """
+        return cls._fromCompact(cls._compactNode(node), session)
 
     def __get_object_from_node(self, node, obj_type=''):
         """
         Copy values from a node into a new Object
         """
         if obj_type == '':
-            constructor = globals()[self.__name__]
+            constructor = type(self)
         else:
-            constructor = globals()[obj_type]
-        obj = constructor(self.api_key, self.sub_domain)
-
-        for childnodes in node.childNodes:
-            if childnodes.nodeType == 1 and not childnodes.nodeName == '':
-                if childnodes.nodeName in self.__attribute_types__:
-
-                    obj.__setattr__(childnodes.nodeName,
-                        self._applyS(childnodes.toxml(encoding='utf-8'),
-                        self.__attribute_types__[childnodes.nodeName],
-                            childnodes.nodeName))
-                else:
-                    node_value = self.__get_xml_value(childnodes.childNodes)
-                    if "type" in  childnodes.attributes.keys():
-                        node_type = childnodes.attributes["type"]
-                        if node_value:
-                            if node_type.nodeValue == 'datetime':
-                                node_value = datetime.datetime.fromtimestamp(
-                                    iso8601.parse(node_value))
-                    obj.__setattr__(childnodes.nodeName, node_value)
-        return obj
+            constructor = ChargifyResourceType.resources[obj_type]
+        return constructor._fromNode(node, self.session)
 
     def fix_xml_encoding(self, xml):
         """
@@ -183,6 +1087,7 @@ class ChargifyBase(object):
         """
         Apply the values of the passed xml data to the a class
         """
+        deadline_timeout()
         dom = minidom.parseString(xml)
         nodes = dom.getElementsByTagName(node_name)
         if nodes.length == 1:
@@ -192,39 +1097,43 @@ class ChargifyBase(object):
         """
         Apply the values of the passed data to a new class of the current type
         """
+        deadline_timeout()
+        parser = self.session.parser
+        if parser is not None and len(xml) >= parser.min_size:
+            return parser.parse(xml, obj_type or type(self).__name__,
+                node_name, self.session)
         dom = minidom.parseString(xml)
         nodes = dom.getElementsByTagName(node_name)
         objs = []
-        for node in nodes:
+        deadline = current_deadline()
+        for i, node in enumerate(nodes):
+            if deadline is not None and i % 100 == 99:
+                deadline.remaining()
             objs.append(self.__get_object_from_node(node, obj_type))
         return objs
 
-    def _toxml(self, dom):
+    def _toxml(self, dom, fields=None):
         """
-        Return a XML Representation of the object
+        Return a XML Representation of the object, or of only the named
+        fields of it
         """
         element = minidom.Element(self.__xmlnodename__)
+        declared = self.__fields__
+        partial = fields is not None
         for property, value in self.__dict__.iteritems():
-            if not property in self.__ignore__ and not inspect.isfunction(value):
-                if property in self.__attribute_types__:
-                    if type(value) == list:
-                        node = minidom.Element(property)
-                        node.setAttribute('type', 'array')
-                        for v in value:
-                            child = v._toxml(dom)
-                            if child is not None:
-                                node.appendChild(child)
-                        element.appendChild(node)
-                    else:
-                        element.appendChild(value._toxml(dom))
-                else:
-                    node = minidom.Element(property)
-                    if type(value) == type(datetime.datetime.now()) or type(value) == type(datetime.date.today()):
-                        node_txt = dom.createTextNode(value.isoformat().encode('ascii', 'xmlcharrefreplace'))
-                    else:
-                        node_txt = dom.createTextNode(value.encode('ascii', 'xmlcharrefreplace'))
-                    node.appendChild(node_txt)
-                    element.appendChild(node)
+            if partial and property not in fields:
+                continue
+            if value is None or property in self.__ignore__ or \
+                    isinstance(value, types.FunctionType):
+                continue
+            field = declared.get(property)
+            if field is None:
+                field = _value_field(value)
+            elif field.read_only:
+                continue
+            node = field.toNode(dom, property, value, partial)
+            if node is not None:
+                element.appendChild(node)
         return element
 
     def _get(self, url):
@@ -255,87 +1164,70 @@ class ChargifyBase(object):
         """
         Handled the request and sends it to the server
         """
-        http = httplib.HTTPSConnection(self.request_host)
-
-        http.putrequest(method, url)
-        http.putheader("Authorization", "Basic %s" % self._get_auth_string())
-        http.putheader("User-Agent", "pychargify")
-        http.putheader("Host", self.request_host)
-        http.putheader("Accept", "application/xml")
-
-        if data:
-            http.putheader("Content-Length", str(len(data)))
-
-        http.putheader("Content-Type", 'text/xml; charset="UTF-8"')
-        http.endheaders()
-
-        if data:
-            http.send(data)
+        status, reason, r = self.session.request(method, url, data)
+        self._check_status(status, reason)
+        return self.fix_xml_encoding(r)
 
-        log.debug('Requesting to %s' % url)
-        response = http.getresponse()
-        r = response.read()
+    def _stream(self, url):
+        """
+        GET a response as a file like object, for incremental parsing
+        """
+        status, reason, fp = self.session.stream('GET', url)
+        if status >= 400:
+            fp.close()
+        self._check_status(status, reason)
+        return fp
 
+    def _check_status(self, status, reason):
+        """
+        Raise the error matching an HTTP error status
+        """
         # Unauthorized Error
-        if response.status == 401:
+        if status == 401:
             raise ChargifyUnAuthorized()
 
         # Forbidden Error
-        elif response.status == 403:
+        elif status == 403:
             raise ChargifyForbidden()
 
         # Not Found Error
-        elif response.status == 404:
+        elif status == 404:
             raise ChargifyNotFound()
 
         # Unprocessable Entity Error
-        elif response.status == 422:
+        elif status == 422:
             raise ChargifyUnProcessableEntity()
 
         # Generic Server Errors
-        elif response.status in [405, 500]:
-            log.debug('response status: %s' % response.status)
-            log.debug('response reason: %s' % response.reason)
+        elif status in [405, 500]:
+            log.debug('response status: %s' % status)
+            log.debug('response reason: %s' % reason)
             raise ChargifyServerError()
 
-        return self.fix_xml_encoding(r)
-
-    def _save(self, url, node_name):
+    def _save(self, url, node_name, fields=None):
         """
-        Save the object using the passed URL as the API end point
+        Save the object using the passed URL as the API end point. fields
+        limits the payload to the named attributes.
         """
         dom = minidom.Document()
-        dom.appendChild(self._toxml(dom))
+        dom.appendChild(self._toxml(dom, fields))
 
-        request_made = {
-            'day': datetime.datetime.today().day,
-            'month': datetime.datetime.today().month,
-            'year': datetime.datetime.today().year
-        }
         if self.id:
-            obj = self._applyS(self._put('/' + url + '/' + self.id + '.xml',
-                dom.toxml(encoding="utf-8")), self.__name__, node_name)
-            if obj:
-                if type(obj.updated_at) == datetime.datetime:
-                    if (obj.updated_at.day == request_made['day']) and \
-                        (obj.updated_at.month == request_made['month']) and \
-                        (obj.updated_at.year == request_made['year']):
-                        self.saved = True
-                        return (True, obj)
-            return (False, obj)
+            method, path = 'PUT', '/%s/%s.xml' % (url, self.id)
         else:
-            obj = self._applyS(self._post('/' + url + '.xml',
-                dom.toxml(encoding="utf-8")), self.__name__, node_name)
-            if obj:
-                if type(obj.updated_at) == datetime.datetime:
-                    if (obj.updated_at.day == request_made['day']) and \
-                        (obj.updated_at.month == request_made['month']) and \
-                        (obj.updated_at.year == request_made['year']):
-                        return (True, obj)
-            return (False, obj)
+            method, path = 'POST', '/%s.xml' % url
+        status, reason, r = self.session.request(method, path,
+            dom.toxml(encoding="utf-8"))
+        self._check_status(status, reason)
+
+        obj = self._applyS(self.fix_xml_encoding(r), self.__name__, node_name)
+        saved = status in (200, 201) and obj is not None
+        if saved and method == 'PUT':
+            self.__dict__['saved'] = True
+        return (saved, obj)
 
     def _get_auth_string(self):
-        return base64.encodestring('%s:%s' % (self.api_key, 'x'))[:-1]
+        return self.session.auth_header[len('Basic '):]
 
     def getAll(self):
         if self.Meta.listing:
@@ -356,11 +1248,113 @@ class ChargifyBase(object):
         raise NotImplementedError('Subclass is missing Meta class attribute listing')
 
     def save(self):
+        """
+        Save the object. Objects loaded from the API only send the fields
+        changed since, and nothing at all when unchanged.
+        """
         if self.Meta.listing:
-            return self._save(self.Meta.listing, self.__xmlnodename__)
+            fields = self._changedFields() if self.id else None
+            if fields == []:
+                return (True, None)
+            result = self._save(self.Meta.listing, self.__xmlnodename__,
+                fields)
+            if result[0]:
+                self._markClean()
+            return result
         raise NotImplementedError('Subclass is missing Meta class attribute listing')
 
 
+def _freeze_value(value):
+    if isinstance(value, ChargifyBase):
+        return value.freeze()
+    if isinstance(value, list):
+        return tuple(_freeze_value(v) for v in value)
+    return value
+
+
+def _thaw_value(value):
+    if isinstance(value, ChargifyFrozen):
+        return value.thaw()
+    if isinstance(value, tuple):
+        return [_thaw_value(v) for v in value]
+    return value
+
+
+class ChargifyFrozen(object):
+    """
+    An immutable snapshot of a resource object. Fields read like the
+    original's; assigning raises AttributeError. Snapshots of equal
+    objects compare and hash equal. Call thaw() for an editable copy to
+    change and save; the snapshot itself is never modified.
+    @license    GNU General Public License
+    """
+    __slots__ = ('resource_type', 'session', '_values', '_dirty', '_loaded',
+        '_hash')
+
+    def __init__(self, obj):
+        values = dict((key, _freeze_value(value))
+            for key, value in obj.__getstate__().iteritems())
+        set = object.__setattr__
+        set(self, 'resource_type', type(obj))
+        set(self, 'session', obj.session)
+        set(self, '_values', values)
+        set(self, '_dirty', frozenset(obj.__dict__.get('_dirty', ())))
+        set(self, '_loaded', obj._loaded)
+        set(self, '_hash', None)
+
+    def __getattr__(self, name):
+        try:
+            return self._values[name]
+        except KeyError:
+            pass
+        value = getattr(self.resource_type, name)
+        if callable(value):
+            raise AttributeError('%s is read only, thaw() it to call %s' %
+                (self.resource_type.__name__, name))
+        return value
+
+    def __setattr__(self, name, value):
+        raise AttributeError('%s snapshots are read only' %
+            self.resource_type.__name__)
+
+    __delattr__ = __setattr__
+
+    def items(self):
+        return sorted(self._values.iteritems())
+
+    def __eq__(self, other):
+        return isinstance(other, ChargifyFrozen) and \
+            self.resource_type is other.resource_type and \
+            self._values == other._values
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        if self._hash is None:
+            object.__setattr__(self, '_hash',
+                hash((self.resource_type.__name__, tuple(self.items()))))
+        return self._hash
+
+    def __repr__(self):
+        return '<Frozen %s %s>' % (self.resource_type.__name__,
+            self._values.get('id'))
+
+    def thaw(self):
+        """
+        Return a new, editable instance carrying the same values and the
+        same record of changed fields
+        """
+        obj = self.resource_type(session=self.session)
+        obj.__dict__.update((key, _thaw_value(value))
+            for key, value in self._values.iteritems())
+        if self._loaded:
+            # Thawed nested objects carry their own record of changes
+            obj._markClean(nested=False)
+        obj.__dict__['_dirty'] = set(self._dirty)
+        return obj
+
+
 class CompoundKeyMixin:
     def getByCompoundKey(self, parent_id, sub_id):
         if 'compound_key' in self.Meta.__dict__.keys():
@@ -375,7 +1369,66 @@ class CompoundKeyMixin:
         raise NotImplementedError('Subclass is missing Meta class attribute compound key')
 
 
-class ChargifyCustomer(ChargifyBase):
+class ChargifyChanges(object):
+    """
+    Iterates over the objects of a listing updated at or after a point in
+    time, newest first. Once exhausted, watermark holds the newest
+    updated_at seen (or the original point in time when nothing changed),
+    ready to be persisted and passed to the next changedSince call.
+    Objects updated exactly at the watermark are yielded again next time.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, resource, since, per_page):
+        self.resource = resource
+        self.since = since
+        self.per_page = per_page
+        self.watermark = since
+
+    def _page_url(self, page):
+        start = iso8601.tostring(time.mktime(self.since.timetuple()))
+        return '/%s.xml?%s' % (self.resource.Meta.listing, urllib.urlencode([
+            ('page', page),
+            ('per_page', self.per_page),
+            ('date_field', 'updated_at'),
+            ('start_datetime', start),
+            ('sort', 'updated_at'),
+            ('direction', 'desc'),
+        ]))
+
+    def __iter__(self):
+        resource = self.resource
+        page = 1
+        while True:
+            objs = resource._applyA(resource._get(self._page_url(page)),
+                resource.__name__, resource.__xmlnodename__)
+            for obj in objs:
+                updated_at = obj.updated_at
+                if isinstance(updated_at, datetime.datetime):
+                    if updated_at < self.since:
+                        # Listing is in updated_at order, everything after
+                        # this one is older still.
+                        return
+                    if updated_at > self.watermark:
+                        self.watermark = updated_at
+                yield obj
+            if len(objs) < self.per_page:
+                return
+            page += 1
+
+
+class ChangedSinceMixin:
+    def changedSince(self, since, per_page=200):
+        """
+        Returns a ChargifyChanges iterator over the objects updated at or
+        after the since datetime (naive, local time like updated_at)
+        """
+        if self.Meta.listing:
+            return ChargifyChanges(self, since, per_page)
+        raise NotImplementedError('Subclass is missing Meta class attribute listing')
+
+
+class ChargifyCustomer(ChargifyBase, ChangedSinceMixin):
     """
     Represents Chargify Customers
     @license    GNU General Public License
@@ -385,32 +1438,28 @@ class ChargifyCustomer(ChargifyBase):
         listing = 'customers'
 
     __name__ = 'ChargifyCustomer'
-    __attribute_types__ = {}
     __xmlnodename__ = 'customer'
 
-    id = None
-    reference = ''
-    first_name = ''
-    last_name = ''
-    email = ''
-    phone = None
-    organization = ''
-    address = ''
-    address_2 = ''
-    city = ''
-    country = ''
-    state = ''
-    zip = ''
-    created_at = None
-    updated_at = None
-
-
-    def __init__(self, apikey, subdomain):
-        super(ChargifyCustomer, self).__init__(apikey, subdomain)
-        self.getByReference = lambda v: self.__get_by_attribute__('reference', v)
+    id = ChargifyIntegerField()
+    reference = ChargifyStringField()
+    first_name = ChargifyStringField()
+    last_name = ChargifyStringField()
+    email = ChargifyStringField()
+    phone = ChargifyStringField(None)
+    organization = ChargifyStringField()
+    address = ChargifyStringField()
+    address_2 = ChargifyStringField()
+    city = ChargifyStringField()
+    country = ChargifyStringField()
+    state = ChargifyStringField()
+    zip = ChargifyStringField()
+
+
+    def getByReference(self, reference):
+        return self.__get_by_attribute__('reference', reference)
 
     def getSubscriptions(self):
-        obj = ChargifySubscription(self.api_key, self.sub_domain)
+        obj = ChargifySubscription(session=self.session)
         return obj.getByCustomerId(self.id)
 
 
@@ -428,38 +1477,34 @@ class ChargifyProductFamily(ChargifyBase):
         listing = 'product_families'
 
     __name__ = 'ChargifyProductFamily'
-    __attribute_types__ = {}
     __xmlnodename__ = 'product_family'
 
-    id = None
-    accounting_code = None
-    description = ''
-    handle = ''
-    name = ''
+    id = ChargifyIntegerField()
+    accounting_code = ChargifyStringField(None)
+    description = ChargifyStringField()
+    handle = ChargifyStringField()
+    name = ChargifyStringField()
 
     def __str__(self):
         return '%s' % self.handle
 
     def getComponents(self):
-        obj = ChargifyProductFamilyComponent(self.api_key, self.sub_domain)
+        obj = ChargifyProductFamilyComponent(session=self.session)
         return obj.getByProductFamilyId(self.id)
 
 
 class ChargifyProductFamilyComponent(ChargifyBase):
 
     __name__ = 'ChargifyProductFamilyComponent'
-    __attribute_types__ = {}
     __xmlnodename__ = 'component'
 
-    id = None
-    name = ''
-    kind = ''
-    product_family_id = 0
-    price_per_unit_in_cents = 0
-    pricing_scheme = ''
-    unit_name = None
-    updated_at = None
-    created_at = None
+    id = ChargifyIntegerField()
+    name = ChargifyStringField()
+    kind = ChargifyStringField()
+    product_family_id = ChargifyIntegerField(0)
+    price_per_unit_in_cents = ChargifyCentsField()
+    pricing_scheme = ChargifyStringField()
+    unit_name = ChargifyStringField(None)
 
     def __str__(self):
         return '%s' % self.name
@@ -474,7 +1519,7 @@ class ChargifyProductFamilyComponent(ChargifyBase):
         components = self._applyA(
             self._get(url), self.__name__, self.__xmlnodename__)
         if components:
-            filtered = filter(lambda c: c.id==str(id), components)
+            filtered = filter(lambda c: str(c.id) == str(id), components)
             if len(filtered) > 0:
                 result = filtered[0]
         return result
@@ -483,7 +1528,7 @@ class ChargifyProductFamilyComponent(ChargifyBase):
         """
         Gets product family
         """
-        obj = ChargifyProductFamily(self.api_key, self.sub_domain)
+        obj = ChargifyProductFamily(session=self.session)
         return obj.getById(self.product_family_id)
 
 
@@ -497,19 +1542,16 @@ class ChargifyProduct(ChargifyBase):
         listing = 'products'
 
     __name__ = 'ChargifyProduct'
-    __attribute_types__ = {
-        'product_family': 'ChargifyProductFamily',
-    }
     __xmlnodename__ = 'product'
 
-    id = None
-    price_in_cents = 0
-    name = ''
-    handle = ''
-    product_family = None
-    accounting_code = ''
-    interval_unit = ''
-    interval = 0
+    id = ChargifyIntegerField()
+    price_in_cents = ChargifyCentsField()
+    name = ChargifyStringField()
+    handle = ChargifyStringField()
+    product_family = ChargifyNestedField('ChargifyProductFamily')
+    accounting_code = ChargifyStringField()
+    interval_unit = ChargifyStringField()
+    interval = ChargifyIntegerField(0)
 
     def __str__(self):
         return '%s' % self.handle
@@ -520,7 +1562,7 @@ class ChargifyProduct(ChargifyBase):
 
     def getPaymentPageUrl(self):
         return ('https://' + self.request_host + '/h/' +
-            self.id + '/subscriptions/new')
+            str(self.id) + '/subscriptions/new')
 
     def getPriceInDollars(self):
         return round(float(self.price_in_cents) / 100, 2)
@@ -529,7 +1571,7 @@ class ChargifyProduct(ChargifyBase):
         return "$%.2f" % (self.getPriceInDollars())
 
 
-class ChargifySubscription(ChargifyBase):
+class ChargifySubscription(ChargifyBase, ChangedSinceMixin):
     """
     Represents Chargify Subscriptions
     @license    GNU General Public License
@@ -539,46 +1581,38 @@ class ChargifySubscription(ChargifyBase):
         listing = 'subscriptions'
 
     __name__ = 'ChargifySubscription'
-    __attribute_types__ = {
-        'customer': 'ChargifyCustomer',
-        'product': 'ChargifyProduct',
-        'credit_card': 'ChargifyCreditCard',
-        'components': 'ChargifySubscriptionComponent',
-    }
     __xmlnodename__ = 'subscription'
 
-    id = None
-    state = ''
-    balance_in_cents = 0
-    current_period_started_at = None
-    current_period_ends_at = None
-    trial_started_at = None
-    trial_ended_at = None
-    activated_at = None
-    expires_at = None
-    created_at = None
-    updated_at = None
-    customer = None
-    customer_reference = ''
-    product = None
-    product_handle = ''
-    credit_card = None
-    components = None
-    next_billing_at = None
+    id = ChargifyIntegerField()
+    state = ChargifyStringField()
+    balance_in_cents = ChargifyCentsField()
+    current_period_started_at = ChargifyDateTimeField()
+    current_period_ends_at = ChargifyDateTimeField()
+    trial_started_at = ChargifyDateTimeField()
+    trial_ended_at = ChargifyDateTimeField()
+    activated_at = ChargifyDateTimeField()
+    expires_at = ChargifyDateTimeField()
+    customer = ChargifyNestedField('ChargifyCustomer')
+    customer_reference = ChargifyStringField()
+    product = ChargifyNestedField('ChargifyProduct')
+    product_handle = ChargifyStringField()
+    credit_card = ChargifyNestedField('ChargifyCreditCard')
+    components = ChargifyArrayField('ChargifySubscriptionComponent')
+    next_billing_at = ChargifyDateTimeField()
 
     def getComponents(self):
         """
         Gets the subscription components
         """
         if self.id is not None:
-            obj = ChargifySubscriptionComponent(self.api_key, self.sub_domain)
+            obj = ChargifySubscriptionComponent(session=self.session)
             return obj.getBySubscriptionId(self.id)
 
     def getComponent(self, component_id):
         """
         Gets a subscription component..
         """
-        obj = ChargifySubscriptionComponent(self.api_key, self.sub_domain)
+        obj = ChargifySubscriptionComponent(session=self.session)
         return obj.getByCompoundKey(self.id, component_id)
 
     def getByCustomerId(self, customer_id):
@@ -592,10 +1626,10 @@ class ChargifySubscription(ChargifyBase):
         return i
 
     def resetBalance(self):
-        self._put("/subscriptions/" + self.id + "/reset_balance.xml", '')
+        self._put("/subscriptions/" + str(self.id) + "/reset_balance.xml", '')
 
     def reactivate(self):
-        self._put("/subscriptions/" + self.id + "/reactivate.xml", "")
+        self._put("/subscriptions/" + str(self.id) + "/reactivate.xml", "")
 
     def upgrade(self, toProductHandle):
         xml = """<?xml version="1.0" encoding="UTF-8"?>
@@ -604,7 +1638,7 @@ class ChargifySubscription(ChargifyBase):
   </subscription>""" % (toProductHandle)
         #end improper indentation
 
-        return self._applyS(self._put("/subscriptions/" + self.id + ".xml",
+        return self._applyS(self._put("/subscriptions/" + str(self.id) + ".xml",
             xml), self.__name__, "subscription")
 
     def unsubscribe(self, message):
@@ -615,7 +1649,7 @@ class ChargifySubscription(ChargifyBase):
   </cancellation_message>
 </subscription>""" % (message)
 
-        self._delete("/subscriptions/" + self.id + ".xml", xml)
+        self._delete("/subscriptions/" + str(self.id) + ".xml", xml)
 
 
 class ChargifyCreditCard(ChargifyBase):
@@ -623,22 +1657,21 @@ class ChargifyCreditCard(ChargifyBase):
     Represents Chargify Credit Cards
     """
     __name__ = 'ChargifyCreditCard'
-    __attribute_types__ = {}
     __xmlnodename__ = 'credit_card_attributes'
 
-    first_name = ''
-    last_name = ''
-    full_number = ''
-    masked_card_number = ''
-    expiration_month = ''
-    expiration_year = ''
-    cvv = ''
-    type = ''
-    billing_address = ''
-    billing_city = ''
-    billing_state = ''
-    billing_zip = ''
-    billing_country = ''
+    first_name = ChargifyStringField()
+    last_name = ChargifyStringField()
+    full_number = ChargifyStringField()
+    masked_card_number = ChargifyStringField()
+    expiration_month = ChargifyIntegerField('')
+    expiration_year = ChargifyIntegerField('')
+    cvv = ChargifyStringField()
+    type = ChargifyStringField()
+    billing_address = ChargifyStringField()
+    billing_city = ChargifyStringField()
+    billing_state = ChargifyStringField()
+    billing_zip = ChargifyStringField()
+    billing_country = ChargifyStringField()
 
     def save(self, subscription):
         path = "/subscriptions/%s.xml" % (subscription.id)
@@ -658,20 +1691,19 @@ class ChargifySubscriptionComponent(ChargifyBase, CompoundKeyMixin):
         compound_key = ('subscriptions', 'components')
 
     __name__ = 'ChargifySubscriptionComponent'
-    __attribute_types__ = {}
     __xmlnodename__ = 'component'
 
-    component_id = None
-    subscription_id = None
-    name = ''
-    kind = ''
-    unit_name = None
-    unit_balance = 0 # metered-component
-    allocated_quantity = 0 # quantity-based-component
-    pricing_scheme = '' # quantity-based-component
-    enabled = False # on-off-component
-
-    def _toxml(self, dom):
+    component_id = ChargifyIntegerField()
+    subscription_id = ChargifyIntegerField()
+    name = ChargifyStringField()
+    kind = ChargifyStringField()
+    unit_name = ChargifyStringField(None)
+    unit_balance = ChargifyIntegerField(0) # metered-component
+    allocated_quantity = ChargifyIntegerField(0) # quantity-based-component
+    pricing_scheme = ChargifyStringField() # quantity-based-component
+    enabled = ChargifyBooleanField(False) # on-off-component
+
+    def _toxml(self, dom, fields=None):
         """
         Return a XML Representation of the object
         """
@@ -683,8 +1715,8 @@ class ChargifySubscriptionComponent(ChargifyBase, CompoundKeyMixin):
         else:
             property = 'allocated_quantity'
 
-        value = getattr(self, property)
-        if not value:
+        value = self.__dict__.get(property)
+        if value is None:
             return None
 
         element = minidom.Element(self.__xmlnodename__)
@@ -692,10 +1724,8 @@ class ChargifySubscriptionComponent(ChargifyBase, CompoundKeyMixin):
         node_txt = dom.createTextNode(str(self.component_id))
         node.appendChild(node_txt)
         element.appendChild(node)
-        node = minidom.Element(property)
-        node_txt = dom.createTextNode(str(value))
-        node.appendChild(node_txt)
-        element.appendChild(node)
+        element.appendChild(self.__fields__[property].toNode(dom, property,
+            value, False))
         return element
 
     def getBySubscriptionId(self, id):
@@ -752,7 +1782,7 @@ class ChargifySubscriptionComponent(ChargifyBase, CompoundKeyMixin):
         if self.kind != 'metered_component':
             raise ChargifyError()
 
-        obj = ChargifyComponentUsage(self.api_key, self.sub_domain)
+        obj = ChargifyComponentUsage(session=self.session)
         return obj.getByCompoundKey(self.subscription_id, self.component_id)
 
     def createUsage(self, quantity, memo=None):
@@ -785,12 +1815,11 @@ class ChargifyComponentUsage(ChargifyBase, CompoundKeyMixin):
         compound_key = ('subscriptions', 'components', 'usages')
 
     __name__ = 'ChargifyComponentUsage'
-    __attribute_types__ = {}
     __xmlnodename__ = 'usage'
 
-    id = None
-    quantity = 0
-    memo = ''
+    id = ChargifyIntegerField()
+    quantity = ChargifyIntegerField(0)
+    memo = ChargifyStringField()
 
 
 class ChargifyPostBack(ChargifyBase):
@@ -798,10 +1827,11 @@ class ChargifyPostBack(ChargifyBase):
     Represents Chargify API Post Backs
     @license    GNU General Public License
     """
-    subscriptions = []
 
-    def __init__(self, apikey, subdomain, postback_data):
-        ChargifyBase.__init__(apikey, subdomain)
+    def __init__(self, apikey=None, subdomain=None, postback_data=None,
+                 session=None):
+        super(ChargifyPostBack, self).__init__(apikey, subdomain, session)
+        self.subscriptions = []
         if postback_data:
             self._process_postback_data(postback_data)
 
@@ -809,12 +1839,160 @@ class ChargifyPostBack(ChargifyBase):
         """
         Process the Json array and fetches the Subscription Objects
         """
-        csub = ChargifySubscription(self.api_key, self.sub_domain)
+        csub = ChargifySubscription(session=self.session)
         postdata_objects = json.loads(data)
         for obj in postdata_objects:
             self.subscriptions.append(csub.getBySubscriptionId(obj))
 
 
+class ChargifyUnitOfWork(object):
+    """
+    Collects objects to save and writes them in one flush, concurrently
+    with at most workers requests in flight. Adding an object more than
+    once saves it once. Objects loaded from the API, or registered with
+    track() before they are changed, are sent with only the fields that
+    changed since and skipped when unchanged.
+
+        with chargify.UnitOfWork(workers=8) as uow:
+            for row in rows:
+                customer = chargify.Customer()
+                ...
+                uow.add(customer)
+
+    @license    GNU General Public License
+    """
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        self._objects = []
+        # id() of every object in _objects
+        self._added = set()
+        self._snapshots = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def _snapshot(self, obj):
+        # Frozen values copy nested objects too, so changes made to them
+        # in place show up against the snapshot
+        return obj.freeze()._values
+
+    def track(self, obj):
+        """
+        Register an unchanged object, remembering its current state
+        """
+        self._lock.acquire()
+        try:
+            self._snapshots[id(obj)] = self._snapshot(obj)
+            self._add(obj)
+        finally:
+            self._lock.release()
+        return obj
+
+    def add(self, obj):
+        """
+        Register an object to be saved on the next flush
+        """
+        self._lock.acquire()
+        try:
+            self._add(obj)
+        finally:
+            self._lock.release()
+        return obj
+
+    def _add(self, obj):
+        if not obj.Meta.listing:
+            raise ChargifyError('%s cannot be saved in a unit of work' %
+                obj.__name__)
+        if id(obj) not in self._added:
+            self._added.add(id(obj))
+            self._objects.append(obj)
+
+    def _changed(self, obj, snapshot):
+        if not obj.id:
+            return None
+        if snapshot is None:
+            return obj._changedFields()
+        current = self._snapshot(obj)
+        return sorted(key for key, value in current.iteritems()
+            if key not in snapshot or snapshot[key] != value)
+
+    def changedFields(self, obj):
+        """
+        The fields that will be sent for an object, None meaning all
+        """
+        return self._changed(obj, self._snapshots.get(id(obj)))
+
+    def _save(self, obj, snapshot):
+        fields = self._changed(obj, snapshot)
+        if fields is not None and not fields:
+            return (obj, True, None)
+        try:
+            saved, result = obj._save(obj.Meta.listing, obj.__xmlnodename__,
+                fields)
+            if saved:
+                obj._markClean()
+            return (obj, saved, result)
+        except (ChargifyError, socket.error, httplib.HTTPException,
+                expat.ExpatError), e:
+            # Connection failures and unparseable responses, such as the
+            # HTML page of a 5xx, fail this object only
+            return (obj, False, e)
+
+    def _save_group(self, group):
+        return [self._save(obj, snapshot) for obj, snapshot in group]
+
+    def flush(self):
+        """
+        Save every registered object and return a list of (object, saved,
+        result) tuples in the order they were added, where result is the
+        object returned by the API or the error raised saving it: a
+        ChargifyError, socket.error, httplib.HTTPException or ExpatError.
+        Objects that did not change are not sent.
+        """
+        self._lock.acquire()
+        try:
+            objects, self._objects = self._objects, []
+            self._added = set()
+            snapshots, self._snapshots = self._snapshots, {}
+        finally:
+            self._lock.release()
+        if not objects:
+            return []
+
+        # Objects sharing an API id are saved one after another so their
+        # writes cannot race each other
+        groups = {}
+        order = []
+        for obj in objects:
+            key = (obj.__name__, obj.id) if obj.id else id(obj)
+            if key not in groups:
+                groups[key] = []
+                order.append(key)
+            groups[key].append((obj, snapshots.get(id(obj))))
+
+        if self.workers > 1 and len(order) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(min(self.workers, len(order)))
+            try:
+                # Saves still queued when the deadline passes fail fast
+                results = pool.map(bind_deadline(self._save_group),
+                    [groups[key] for key in order])
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [self._save_group(groups[key]) for key in order]
+
+        by_object = dict((id(r[0]), r) for group in results for r in group)
+        return [by_object[id(obj)] for obj in objects]
+
+
 class Chargify:
     """
     The Chargify class provides the main entry point to the Charify API
@@ -823,66 +2001,78 @@ class Chargify:
     api_key = ''
     sub_domain = ''
 
-    def __init__(self, apikey, subdomain):
+    def __init__(self, apikey, subdomain, cache=None, pool_size=4,
+                 transport=None, compress_min_size=None, connect_timeout=10,
+                 read_timeout=60, breaker=None, parser=None):
         self.api_key = apikey
         self.sub_domain = subdomain
+        self.session = ChargifySession(apikey, subdomain, cache=cache,
+            pool_size=pool_size, transport=transport,
+            compress_min_size=compress_min_size,
+            connect_timeout=connect_timeout, read_timeout=read_timeout,
+            breaker=breaker, parser=parser)
 
     def Customer(self):
-        return ChargifyCustomer(self.api_key, self.sub_domain)
+        return ChargifyCustomer(session=self.session)
 
     def CustomerAttributes(self):
-        return CustomerAttributes(self.api_key, self.sub_domain)
+        return CustomerAttributes(session=self.session)
 
     def Product(self):
-        return ChargifyProduct(self.api_key, self.sub_domain)
+        return ChargifyProduct(session=self.session)
 
     def Component(self):
-        return ChargifyProductFamilyComponent(self.api_key,
-            self.sub_domain)
+        return ChargifyProductFamilyComponent(session=self.session)
 
     def ProductFamily(self):
-        return ChargifyProductFamily(self.api_key, self.sub_domain)
+        return ChargifyProductFamily(session=self.session)
 
     def Subscription(self):
-        return ChargifySubscription(self.api_key, self.sub_domain)
+        return ChargifySubscription(session=self.session)
 
     def SubscriptionComponent(self):
-        return ChargifySubscriptionComponent(self.api_key,
-            self.sub_domain)
+        return ChargifySubscriptionComponent(session=self.session)
 
     def ComponentUsage(self):
-        return ChargifyComponentUsage(self.api_key, self.sub_domain)
+        return ChargifyComponentUsage(session=self.session)
 
     def CreditCard(self):
-        return ChargifyCreditCard(self.api_key, self.sub_domain)
+        return ChargifyCreditCard(session=self.session)
+
+    def UnitOfWork(self, workers=4):
+        return ChargifyUnitOfWork(workers)
+
+    def deadline(self, timeout):
+        return ChargifyDeadline(timeout)
 
     def PostBack(self, postbackdata):
-        return ChargifyPostBack(self.api_key, self.sub_domain, postbackdata)
+        return ChargifyPostBack(postback_data=postbackdata,
+            session=self.session)
 
     @property
     def Customers(self):
-        return ChargifyCustomer(self.api_key, self.sub_domain)
+        return ChargifyCustomer(session=self.session)
 
     @property
     def Products(self):
-        return ChargifyProduct(self.api_key, self.sub_domain)
+        return ChargifyProduct(session=self.session)
 
     @property
     def Components(self):
-        return ChargifyProductFamilyComponent(self.api_key, self.sub_domain)
+        return ChargifyProductFamilyComponent(session=self.session)
 
     @property
     def ProductFamilies(self):
-        return ChargifyProductFamily(self.api_key, self.sub_domain)
+        return ChargifyProductFamily(session=self.session)
 
     @property
     def Subscriptions(self):
-        return ChargifySubscription(self.api_key, self.sub_domain)
+        return ChargifySubscription(session=self.session)
 
     @property
     def SubscriptionComponents(self):
-        return ChargifySubscriptionComponent(self.api_key, self.sub_domain)
+        return ChargifySubscriptionComponent(session=self.session)
 
     @property
     def ComponentUsages(self):
-        return ChargifyComponentUsage(self.api_key, self.sub_domain)
+        return ChargifyComponentUsage(session=self.session)
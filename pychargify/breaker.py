@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Circuit breakers for ChargifySession.
+
+    chargify = Chargify('YOUR-API-KEY', 'YOUR-SUB-DOMAIN', read_timeout=10,
+        breaker=ChargifyCircuitBreaker())
+
+Requests are grouped into endpoint families (subscriptions, customers,
+components, ...) by their URL, each with its own circuit. A circuit opens
+when too many of its recent requests failed or were slow; while open every
+request to that family raises ChargifyCircuitOpen without touching the
+network. After reset_timeout one probe request is let through, closing the
+circuit again when it succeeds.
+
+Requests that fail because the caller's own ChargifyDeadline ran out are
+not counted, one caller's tight budget says nothing about the endpoint.
+'''
+
+import collections
+import threading
+import time
+
+from api import ChargifyDeadlineExceeded, ChargifyError, deadline_passed
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class ChargifyCircuitOpen(ChargifyError):
+    """
+    Raised instead of sending a request while the circuit for its
+    endpoint family is open
+    @license    GNU General Public License
+    """
+
+    def __init__(self, family, retry_in):
+        ChargifyError.__init__(self, 'Circuit for %s is open, retry in %.1fs'
+            % (family, retry_in))
+        self.family = family
+        self.retry_in = retry_in
+
+
+class ChargifyCircuit(object):
+    """
+    The state of one endpoint family: a window of recent outcomes and
+    whether requests are currently let through
+    @license    GNU General Public License
+    """
+
+    def __init__(self, family, breaker):
+        self.family = family
+        self.breaker = breaker
+        self.state = CLOSED
+        self.opened_at = None
+        # (failed, slow) for the most recent requests
+        self._outcomes = collections.deque(maxlen=breaker.window)
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def before(self):
+        """
+        Raise ChargifyCircuitOpen unless a request may be sent now
+        """
+        self._lock.acquire()
+        try:
+            if self.state == CLOSED:
+                return
+            if self.state == OPEN:
+                retry_in = self.opened_at + self.breaker.reset_timeout - \
+                    self.breaker.clock()
+                if retry_in > 0:
+                    raise ChargifyCircuitOpen(self.family, retry_in)
+                self.state = HALF_OPEN
+            if self._probing:
+                # Only one probe at a time while half open
+                raise ChargifyCircuitOpen(self.family, 0)
+            self._probing = True
+        finally:
+            self._lock.release()
+
+    def record(self, failed, elapsed):
+        """
+        Record the outcome of a request sent after before()
+        """
+        slow = elapsed >= self.breaker.slow_threshold
+        breaker = self.breaker
+        self._lock.acquire()
+        try:
+            if self.state == HALF_OPEN:
+                self._probing = False
+                if failed or slow:
+                    self._open()
+                else:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                return
+            if self.state == OPEN:
+                return
+            outcomes = self._outcomes
+            outcomes.append((failed, slow))
+            if len(outcomes) < breaker.min_requests:
+                return
+            total = float(len(outcomes))
+            failures = sum(1 for f, s in outcomes if f)
+            slows = sum(1 for f, s in outcomes if s)
+            if failures / total >= breaker.error_rate or \
+                    slows / total >= breaker.slow_rate:
+                self._open()
+        finally:
+            self._lock.release()
+
+    def release(self):
+        """
+        Record that a request sent after before() ended without saying
+        anything about the endpoint
+        """
+        self._lock.acquire()
+        try:
+            if self.state == HALF_OPEN:
+                self._probing = False
+        finally:
+            self._lock.release()
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = self.breaker.clock()
+        self._outcomes.clear()
+
+
+class ChargifyCircuitBreaker(object):
+    """
+    Keeps one circuit per endpoint family and wraps requests in them.
+
+    A request failed when the transport raised or Chargify answered with
+    a 5xx status, and was slow when it took slow_threshold seconds or more.
+    Once at least min_requests outcomes are in the window of the last
+    window requests, the circuit opens when error_rate of them failed or
+    slow_rate of them were slow. Requests cut short by the caller's
+    ChargifyDeadline are not counted.
+    @license    GNU General Public License
+    """
+    families = ('subscriptions', 'customers', 'components', 'products',
+        'product_families', 'usages', 'transactions', 'charges')
+
+    def __init__(self, error_rate=0.5, slow_rate=0.5, slow_threshold=5.0,
+                 window=20, min_requests=5, reset_timeout=30.0,
+                 clock=time.time):
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_threshold = slow_threshold
+        self.window = window
+        self.min_requests = min_requests
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self._circuits = {}
+        self._lock = threading.Lock()
+
+    def family(self, url):
+        """
+        The endpoint family of a request URL: the innermost known
+        collection in its path, /subscriptions/1/components.xml belongs to
+        components
+        """
+        path = url.split('?', 1)[0]
+        segments = [s.split('.', 1)[0] for s in path.strip('/').split('/')]
+        for segment in reversed(segments):
+            if segment in self.families:
+                return segment
+        return segments[0]
+
+    def circuit(self, url):
+        family = self.family(url)
+        self._lock.acquire()
+        try:
+            circuit = self._circuits.get(family)
+            if circuit is None:
+                circuit = self._circuits[family] = \
+                    ChargifyCircuit(family, self)
+            return circuit
+        finally:
+            self._lock.release()
+
+    def state(self, url):
+        return self.circuit(url).state
+
+    def call(self, url, send):
+        """
+        Call send() through the circuit of url. send must return a tuple
+        whose first item is the response status.
+        """
+        circuit = self.circuit(url)
+        circuit.before()
+        start = self.clock()
+        try:
+            result = send()
+        except Exception, e:
+            if self._cut_by_deadline(e):
+                circuit.release()
+            else:
+                circuit.record(True, self.clock() - start)
+            raise
+        circuit.record(result[0] >= 500, self.clock() - start)
+        return result
+
+    def _cut_by_deadline(self, error):
+        return isinstance(error, ChargifyDeadlineExceeded) or \
+            deadline_passed()
+
+    def reset(self):
+        """
+        Close every circuit
+        """
+        self._lock.acquire()
+        try:
+            self._circuits.clear()
+        finally:
+            self._lock.release()
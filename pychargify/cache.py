@@ -0,0 +1,429 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Response caches for ChargifySession. A cache stores raw response bodies
+keyed by request URL, prefixed with the site and a hash of the API key
+(see ChargifySession.cacheKey), and must provide get, set, delete and
+clear.
+
+ChargifySQLiteCache keeps the entries in a SQLite database on local disk,
+shared by every process on the host that opens the same file, so one
+worker's fetch of /products.xml serves all the others. By default it only
+holds catalog responses, see catalog_url. Keep the file in a directory only
+the application's user can read; it is created readable by its owner only:
+
+    cache = ChargifySQLiteCache('/var/cache/myapp/chargify.db', ttl=300)
+
+ChargifyCatalogWarmer keeps the product, product family and component
+responses of a session's cache fresh from a background thread, so catalog
+lookups are always served from the cache:
+
+    chargify = Chargify('YOUR-API-KEY', 'YOUR-SUB-DOMAIN',
+        cache=ChargifyMemoryCache(ttl=300))
+    warmer = ChargifyCatalogWarmer(chargify.session, interval=240).start()
+'''
+
+import heapq
+import logging
+import os
+import random
+import re
+import sqlite3
+import threading
+import time
+
+from cStringIO import StringIO
+from xml.etree import cElementTree
+
+log = logging.getLogger(__name__)
+
+_catalog_rx = re.compile(r'^/(products|product_families)(/|\.xml)')
+
+
+def catalog_url(url):
+    """
+    Whether url is a product, product family or product family component
+    URL, responses that change rarely and are the same for every caller
+    """
+    return _catalog_rx.match(url) is not None
+
+
+class ChargifyMemoryCache(object):
+    """
+    A thread safe in-process cache with a time to live per entry
+    @license    GNU General Public License
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        Return the cached value or None when missing or expired
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                del self._entries[key]
+                return None
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        self._lock.acquire()
+        try:
+            self._entries[key] = (time.time() + ttl, value)
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            self._entries.pop(key, None)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+        finally:
+            self._lock.release()
+
+
+class ChargifySQLiteCache(object):
+    """
+    A cache shared between processes through a SQLite database at path,
+    with a time to live per entry. The database is in WAL mode, so
+    readers never block each other or the writer, and every write is a
+    single transaction, so readers see either the old or the new body.
+
+    When a write takes the bodies stored past max_size bytes, expired
+    entries are dropped first and then those closest to expiring, until
+    the total is back under the limit. Each process and thread opens its
+    own connection, and waits up to timeout seconds for another writer.
+
+    A new database file is created with mode 0600, the mode of an
+    existing one is left as it is.
+
+    Sessions only cache the URLs cacheable accepts, by default catalog_url.
+    Subscriptions and customers change through many URLs that a write to
+    one does not invalidate, so they are not shared unless cacheable is
+    set to None, which caches every GET.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, path, ttl=300, max_size=64 << 20, timeout=30,
+                 cacheable=catalog_url):
+        self.path = path
+        self.ttl = ttl
+        self.cacheable = cacheable
+        self.max_size = max_size
+        self.timeout = timeout
+        self._local = threading.local()
+        # SQLite creates its -wal and -shm files with the mode of the
+        # database file
+        os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0600))
+        connection = self._connection()
+        connection.execute('PRAGMA journal_mode=WAL')
+        self._write(connection, 'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, value BLOB NOT NULL, '
+            'size INTEGER NOT NULL, expires REAL NOT NULL)')
+        self._write(connection,
+            'CREATE INDEX IF NOT EXISTS entries_expires ON entries (expires)')
+
+    def _connection(self):
+        """
+        The connection of the calling thread, reopened after a fork
+        """
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.connection = sqlite3.connect(self.path,
+                timeout=self.timeout, isolation_level=None)
+            local.connection.execute('PRAGMA synchronous=NORMAL')
+            local.pid = os.getpid()
+        return local.connection
+
+    def _write(self, connection, sql, args=()):
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute(sql, args)
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def get(self, key):
+        """
+        Return the cached value or None when missing or expired
+        """
+        row = self._connection().execute(
+            'SELECT value FROM entries WHERE key = ? AND expires >= ?',
+            (key, time.time())).fetchone()
+        if row is None:
+            return None
+        value = row[0]
+        # Byte strings are stored as blobs, unicode as text
+        if isinstance(value, buffer):
+            value = str(value)
+        return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if isinstance(value, str):
+            size = len(value)
+            value = buffer(value)
+        else:
+            size = len(value.encode('utf-8'))
+        now = time.time()
+        connection = self._connection()
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            connection.execute('INSERT OR REPLACE INTO entries '
+                '(key, value, size, expires) VALUES (?, ?, ?, ?)',
+                (key, value, size, now + ttl))
+            self._evict(connection, now)
+        except:
+            connection.execute('ROLLBACK')
+            raise
+        connection.execute('COMMIT')
+
+    def _total(self, connection):
+        return connection.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+
+    def _evict(self, connection, now):
+        total = self._total(connection)
+        if total <= self.max_size:
+            return
+        connection.execute('DELETE FROM entries WHERE expires < ?', (now,))
+        total = self._total(connection)
+        evict = []
+        for key, size in connection.execute(
+                'SELECT key, size FROM entries ORDER BY expires'):
+            if total <= self.max_size:
+                break
+            evict.append((key,))
+            total -= size
+        connection.executemany('DELETE FROM entries WHERE key = ?', evict)
+
+    def delete(self, key):
+        self._write(self._connection(), 'DELETE FROM entries WHERE key = ?',
+            (key,))
+
+    def clear(self):
+        self._write(self._connection(), 'DELETE FROM entries')
+
+
+class ChargifyCatalogWarmer(object):
+    """
+    Refresh-ahead for catalog data. start() fetches the product family and
+    product listings and, discovered from them, every product by id and
+    by handle, every product family and every family's component listing,
+    storing each in the session's cache. A daemon thread then refetches
+    every URL about each interval seconds, spread by +/- jitter of the
+    interval so the refreshes do not all fall due together.
+
+    Entries are stored for max_stale seconds, well beyond the interval, so
+    a failed refresh keeps the previous response being served while the
+    next attempt is made. Responses that come back 404 are dropped.
+
+    A session without a cache is given a ChargifyMemoryCache that only
+    serves the URLs kept warm, other responses are not cached.
+    @license    GNU General Public License
+    """
+
+    listings = ('/product_families.xml', '/products.xml')
+
+    def __init__(self, session, interval=240, jitter=0.1, max_stale=3600,
+                 clock=time.time):
+        if session.cache is None:
+            session.cache = ChargifyMemoryCache()
+            session.cache_filter = self.isWarm
+        self.session = session
+        self.cache = session.cache
+        self.interval = interval
+        self.jitter = jitter
+        self.max_stale = max_stale
+        self.clock = clock
+        # (due, url) of every URL kept warm
+        self._schedule = []
+        self._urls = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _next_due(self):
+        spread = self.interval * self.jitter
+        return self.clock() + self.interval + random.uniform(-spread, spread)
+
+    def _add(self, url, due):
+        if url not in self._urls:
+            self._urls.add(url)
+            heapq.heappush(self._schedule, (due, url))
+
+    def isWarm(self, url):
+        """
+        Whether url is kept warm
+        """
+        self._lock.acquire()
+        try:
+            return url in self._urls
+        finally:
+            self._lock.release()
+
+    def urls(self):
+        self._lock.acquire()
+        try:
+            return sorted(self._urls)
+        finally:
+            self._lock.release()
+
+    def _discover(self, url, body):
+        """
+        URLs worth keeping warm that a listing response points to
+        """
+        if url not in self.listings:
+            return []
+        found = []
+        for event, elem in cElementTree.iterparse(StringIO(body)):
+            if elem.tag == 'product_family' and \
+                    url == '/product_families.xml':
+                id = elem.findtext('id')
+                found.append('/product_families/%s.xml' % id)
+                found.append('/product_families/%s/components.xml' % id)
+                elem.clear()
+            elif elem.tag == 'product' and url == '/products.xml':
+                found.append('/products/%s.xml' % elem.findtext('id'))
+                found.append('/products/handle/%s.xml' %
+                    elem.findtext('handle'))
+                elem.clear()
+        return found
+
+    def refresh(self, url):
+        """
+        Refetch one URL into the cache, returning whether it should be
+        kept warm
+        """
+        try:
+            status, reason, fp = self.session.stream('GET', url)
+            try:
+                body = fp.read()
+            finally:
+                fp.close()
+        except Exception, e:
+            log.warning('Refreshing %s failed: %s' % (url, e))
+            return True
+        if status == 404:
+            self.cache.delete(self.session.cacheKey(url))
+            return False
+        if status != 200:
+            log.warning('Refreshing %s failed: %s %s' % (url, status, reason))
+            return True
+        self.cache.set(self.session.cacheKey(url), body, self.max_stale)
+
+        found = self._discover(url, body)
+        if found:
+            self._lock.acquire()
+            try:
+                for child in found:
+                    # Spread newly found URLs over the first interval
+                    self._add(child, self.clock() +
+                        random.uniform(0, self.interval))
+            finally:
+                self._lock.release()
+        return True
+
+    def warm(self):
+        """
+        Fetch the whole catalog now, in the calling thread
+        """
+        for url in self.listings:
+            self._lock.acquire()
+            try:
+                self._add(url, self._next_due())
+            finally:
+                self._lock.release()
+            self.refresh(url)
+        for url in self.urls():
+            if url not in self.listings:
+                self.refresh(url)
+
+    def refreshDue(self):
+        """
+        Refresh every URL that is due, returning the seconds until the
+        next one is
+        """
+        while True:
+            self._lock.acquire()
+            try:
+                if not self._schedule:
+                    return self.interval
+                due, url = self._schedule[0]
+                wait = due - self.clock()
+                if wait > 0:
+                    return wait
+                heapq.heappop(self._schedule)
+            finally:
+                self._lock.release()
+
+            # The URL stays in _urls while it is refreshed, so the cache
+            # keeps serving it
+            keep = self.refresh(url)
+            self._lock.acquire()
+            try:
+                if keep:
+                    heapq.heappush(self._schedule, (self._next_due(), url))
+                else:
+                    self._urls.discard(url)
+            finally:
+                self._lock.release()
+
+    def _run(self):
+        while not self._stop.is_set():
+            wait = self.refreshDue()
+            self._stop.wait(max(wait, 0.01))
+
+    def start(self, warm=True):
+        """
+        Warm the catalog, unless warm is False, and start refreshing it in
+        the background
+        """
+        if warm:
+            self.warm()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run,
+            name='pychargify-catalog-warmer')
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
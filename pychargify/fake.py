@@ -0,0 +1,663 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+An in-process stand in for the Chargify API.
+
+ChargifyFakeBackend is a transport that keeps customers, subscriptions,
+products, product families, components and usages in memory and answers
+requests with the same XML the API sends, so the whole request, parse and
+serialize path can run without sockets:
+
+    fake = ChargifyFakeBackend()
+    family = fake.addProductFamily(name='Plans', handle='plans')
+    fake.addProduct(family, name='Basic', handle='basic', price_in_cents=1000)
+
+    chargify = Chargify('YOUR-API-KEY', 'YOUR-SUB-DOMAIN', transport=fake)
+    chargify.Products.getByHandle('basic')
+'''
+
+import base64
+import re
+import threading
+import time
+import urlparse
+
+from xml.etree import cElementTree
+from xml.sax.saxutils import escape
+
+import iso8601
+from api import ChargifyTransport
+
+XML_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n'
+
+COMPONENT_KINDS = ('metered_component', 'quantity_based_component',
+    'on_off_component')
+
+
+class ChargifyFakeError(Exception):
+    """
+    Turned into an error response by ChargifyFakeBackend.request
+    """
+
+    def __init__(self, status, reason, errors=()):
+        Exception.__init__(self, reason)
+        self.status = status
+        self.reason = reason
+        self.errors = errors
+
+
+def _not_found():
+    return ChargifyFakeError(404, 'Not Found')
+
+
+def _invalid(*errors):
+    return ChargifyFakeError(422, 'Unprocessable Entity', errors)
+
+
+class _Timestamp(float):
+    """
+    Seconds since the epoch, rendered as a datetime element
+    """
+    pass
+
+
+def _element(name, value):
+    """
+    Render a value as an XML element the way Chargify types its fields
+    """
+    if isinstance(value, dict):
+        return '<%s>%s</%s>' % (name, ''.join(_element(k, v)
+            for k, v in value.iteritems()), name)
+    if isinstance(value, list):
+        item = name[:-1] if name.endswith('s') else name
+        return '<%s type="array">%s</%s>' % (name, ''.join(_element(item, v)
+            for v in value), name)
+    if value is None:
+        return '<%s nil="true"></%s>' % (name, name)
+    if isinstance(value, bool):
+        return '<%s type="boolean">%s</%s>' % (name, str(value).lower(),
+            name)
+    if isinstance(value, _Timestamp):
+        return '<%s type="datetime">%s</%s>' % (name,
+            iso8601.tostring(int(value)), name)
+    if isinstance(value, (int, long)):
+        return '<%s type="integer">%d</%s>' % (name, value, name)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return '<%s>%s</%s>' % (name, escape(str(value)), name)
+
+
+def _document(name, value):
+    return XML_HEADER + _element(name, value)
+
+
+def _listing(name, item, values):
+    return XML_HEADER + '<%s type="array">%s</%s>' % (name,
+        ''.join(_element(item, v) for v in values), name)
+
+
+def _from_element(elem):
+    """
+    Turn a posted XML element into nested dictionaries of strings
+    """
+    children = list(elem)
+    if not children:
+        return (elem.text or '').strip()
+    return dict((child.tag, _from_element(child)) for child in children)
+
+
+def _parse_body(body):
+    if not body:
+        return {}
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    try:
+        root = cElementTree.fromstring(body)
+    except SyntaxError:
+        raise ChargifyFakeError(400, 'Bad Request')
+    value = _from_element(root)
+    return {root.tag: value if isinstance(value, dict) else {}}
+
+
+def _int(value, field):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise _invalid('%s is not a number' % field)
+
+
+class ChargifyFakeBackend(ChargifyTransport):
+    """
+    A transport answering Chargify API requests from in-memory records
+    @license    GNU General Public License
+    """
+
+    customer_fields = ('first_name', 'last_name', 'email', 'organization',
+        'reference', 'phone', 'address', 'address_2', 'city', 'state', 'zip',
+        'country')
+    credit_card_fields = ('first_name', 'last_name', 'expiration_month',
+        'expiration_year', 'billing_address', 'billing_city', 'billing_state',
+        'billing_zip', 'billing_country')
+
+    def __init__(self, api_key=None, clock=time.time):
+        self.api_key = api_key
+        self.clock = clock
+        self.customers = {}
+        self.subscriptions = {}
+        self.products = {}
+        self.product_families = {}
+        self.components = {}
+        self.subscription_components = {}
+        self.usages = {}
+        self._ids = {}
+        self._lock = threading.RLock()
+        self._routes = [(method, re.compile('^%s$' % pattern), handler)
+            for method, pattern, handler in self.routes()]
+
+    def routes(self):
+        return [
+            ('GET', r'/customers\.xml', self.listCustomers),
+            ('POST', r'/customers\.xml', self.createCustomer),
+            ('GET', r'/customers/lookup\.xml', self.lookupCustomer),
+            ('GET', r'/customers/(\d+)\.xml', self.getCustomer),
+            ('PUT', r'/customers/(\d+)\.xml', self.updateCustomer),
+            ('GET', r'/customers/(\d+)/subscriptions\.xml',
+                self.listCustomerSubscriptions),
+            ('GET', r'/products\.xml', self.listProducts),
+            ('GET', r'/products/(\d+)\.xml', self.getProduct),
+            ('GET', r'/products/handle/([^/]+)\.xml', self.getProductByHandle),
+            ('GET', r'/product_families\.xml', self.listProductFamilies),
+            ('GET', r'/product_families/(\d+)\.xml', self.getProductFamily),
+            ('GET', r'/product_families/(\d+)/components\.xml',
+                self.listComponents),
+            ('GET', r'/subscriptions\.xml', self.listSubscriptions),
+            ('POST', r'/subscriptions\.xml', self.createSubscription),
+            ('GET', r'/subscriptions/(\d+)\.xml', self.getSubscription),
+            ('PUT', r'/subscriptions/(\d+)\.xml', self.updateSubscription),
+            ('DELETE', r'/subscriptions/(\d+)\.xml', self.cancelSubscription),
+            ('PUT', r'/subscriptions/(\d+)/reset_balance\.xml',
+                self.resetBalance),
+            ('PUT', r'/subscriptions/(\d+)/reactivate\.xml', self.reactivate),
+            ('GET', r'/subscriptions/(\d+)/components\.xml',
+                self.listSubscriptionComponents),
+            ('GET', r'/subscriptions/(\d+)/components/(\d+)\.xml',
+                self.getSubscriptionComponent),
+            ('PUT', r'/subscriptions/(\d+)/components/(\d+)\.xml',
+                self.updateSubscriptionComponent),
+            ('GET', r'/subscriptions/(\d+)/components/(\d+)/usages\.xml',
+                self.listUsages),
+            ('POST', r'/subscriptions/(\d+)/components/(\d+)/usages\.xml',
+                self.createUsage),
+        ]
+
+    def _next_id(self, kind):
+        self._ids[kind] = self._ids.get(kind, 0) + 1
+        return self._ids[kind]
+
+    def _now(self):
+        return _Timestamp(int(self.clock()))
+
+    def _authorized(self, headers):
+        if self.api_key is None:
+            return True
+        expected = 'Basic %s' % base64.b64encode('%s:x' % self.api_key)
+        return (headers or {}).get('Authorization') == expected
+
+    def request(self, method, url, body=None, headers=None):
+        if not self._authorized(headers):
+            return 401, 'Unauthorized', ''
+        parts = urlparse.urlsplit(url)
+        params = dict(urlparse.parse_qsl(parts.query))
+        for route_method, pattern, handler in self._routes:
+            if route_method != method:
+                continue
+            match = pattern.match(parts.path)
+            if match is None:
+                continue
+            self._lock.acquire()
+            try:
+                return 200, 'OK', handler(params, _parse_body(body),
+                    *match.groups())
+            except ChargifyFakeError, e:
+                errors = ''.join('<error>%s</error>' % escape(error)
+                    for error in e.errors)
+                return e.status, e.reason, \
+                    XML_HEADER + '<errors>%s</errors>' % errors
+            finally:
+                self._lock.release()
+        return 404, 'Not Found', ''
+
+    def _page(self, records, params):
+        """
+        Apply the date filter, ordering and paging parameters the listing
+        endpoints accept
+        """
+        records = list(records)
+        date_field = params.get('date_field')
+        if date_field:
+            for param, keep in (('start_datetime', lambda v, t: v >= t),
+                    ('end_datetime', lambda v, t: v <= t)):
+                if params.get(param):
+                    limit = iso8601.parse(params[param])
+                    records = [r for r in records
+                        if r.get(date_field) is not None and
+                            keep(r[date_field], limit)]
+        sort = params.get('sort', 'id')
+        records.sort(key=lambda r: r.get(sort),
+            reverse=params.get('direction') == 'desc')
+        page = max(1, int(params.get('page', 1)))
+        per_page = min(200, max(1, int(params.get('per_page', 20))))
+        return records[(page - 1) * per_page:page * per_page]
+
+    def _get(self, store, id):
+        record = store.get(int(id))
+        if record is None:
+            raise _not_found()
+        return record
+
+    # Seeding
+
+    def addProductFamily(self, **fields):
+        self._lock.acquire()
+        try:
+            family = {
+                'id': self._next_id('product_family'),
+                'name': fields.get('name', ''),
+                'handle': fields.get('handle', ''),
+                'description': fields.get('description', ''),
+                'accounting_code': fields.get('accounting_code'),
+            }
+            self.product_families[family['id']] = family
+            return family
+        finally:
+            self._lock.release()
+
+    def addProduct(self, family, **fields):
+        self._lock.acquire()
+        try:
+            now = self._now()
+            product = {
+                'id': self._next_id('product'),
+                'name': fields.get('name', ''),
+                'handle': fields.get('handle', ''),
+                'description': fields.get('description', ''),
+                'accounting_code': fields.get('accounting_code', ''),
+                'price_in_cents': int(fields.get('price_in_cents', 0)),
+                'interval': int(fields.get('interval', 1)),
+                'interval_unit': fields.get('interval_unit', 'month'),
+                'initial_charge_in_cents': None,
+                'trial_price_in_cents': None,
+                'trial_interval': None,
+                'trial_interval_unit': 'month',
+                'created_at': now,
+                'updated_at': now,
+                'product_family_id': family['id'],
+            }
+            self.products[product['id']] = product
+            return product
+        finally:
+            self._lock.release()
+
+    def addComponent(self, family, **fields):
+        kind = fields.get('kind', 'metered_component')
+        if kind not in COMPONENT_KINDS:
+            raise ValueError('Unknown component kind %s' % kind)
+        self._lock.acquire()
+        try:
+            now = self._now()
+            component = {
+                'id': self._next_id('component'),
+                'name': fields.get('name', ''),
+                'kind': kind,
+                'unit_name': fields.get('unit_name', 'unit'),
+                'pricing_scheme': fields.get('pricing_scheme', 'per_unit'),
+                'price_per_unit_in_cents': int(
+                    fields.get('price_per_unit_in_cents', 0)),
+                'product_family_id': family['id'],
+                'created_at': now,
+                'updated_at': now,
+            }
+            self.components[component['id']] = component
+            return component
+        finally:
+            self._lock.release()
+
+    def addCustomer(self, **fields):
+        self._lock.acquire()
+        try:
+            return self._create_customer(fields)
+        finally:
+            self._lock.release()
+
+    def addSubscription(self, customer, product, **fields):
+        self._lock.acquire()
+        try:
+            subscription = self._create_subscription(customer, product,
+                fields.pop('credit_card', None))
+            subscription.update(fields)
+            return subscription
+        finally:
+            self._lock.release()
+
+    # Rendering
+
+    def _render_product(self, product):
+        result = dict(product)
+        result['product_family'] = self.product_families[
+            result.pop('product_family_id')]
+        return result
+
+    def _render_subscription(self, subscription):
+        result = dict(subscription)
+        result['customer'] = self.customers[result.pop('customer_id')]
+        result['product'] = self._render_product(
+            self.products[result.pop('product_id')])
+        if result['credit_card'] is None:
+            del result['credit_card']
+        return result
+
+    def _render_subscription_component(self, subscription_id, component_id):
+        allocation = self.subscription_components[subscription_id][
+            component_id]
+        component = self.components[component_id]
+        return {
+            'component_id': component_id,
+            'subscription_id': subscription_id,
+            'name': component['name'],
+            'kind': component['kind'],
+            'unit_name': component['unit_name'],
+            'pricing_scheme': component['pricing_scheme'],
+            'unit_balance': allocation['unit_balance'],
+            'allocated_quantity': allocation['allocated_quantity'],
+            'enabled': allocation['enabled'],
+        }
+
+    # Customers
+
+    def _create_customer(self, fields):
+        errors = ['%s: cannot be blank.' % f.replace('_', ' ').capitalize()
+            for f in ('first_name', 'last_name', 'email') if not fields.get(f)]
+        if errors:
+            raise _invalid(*errors)
+        reference = fields.get('reference')
+        if reference and any(c['reference'] == reference
+                for c in self.customers.itervalues()):
+            raise _invalid('Reference: must be unique.')
+        now = self._now()
+        customer = dict((f, fields.get(f) or None) for f in
+            self.customer_fields)
+        customer.update({
+            'id': self._next_id('customer'),
+            'created_at': now,
+            'updated_at': now,
+        })
+        self.customers[customer['id']] = customer
+        return customer
+
+    def listCustomers(self, params, data):
+        return _listing('customers', 'customer',
+            self._page(self.customers.itervalues(), params))
+
+    def createCustomer(self, params, data):
+        fields = data.get('customer') or data.get('customer_attributes') or {}
+        return _document('customer', self._create_customer(fields))
+
+    def lookupCustomer(self, params, data):
+        for customer in self.customers.itervalues():
+            if customer['reference'] and \
+                    customer['reference'] == params.get('reference'):
+                return _document('customer', customer)
+        raise _not_found()
+
+    def getCustomer(self, params, data, id):
+        return _document('customer', self._get(self.customers, id))
+
+    def updateCustomer(self, params, data, id):
+        customer = self._get(self.customers, id)
+        fields = data.get('customer') or data.get('customer_attributes') or {}
+        for field in self.customer_fields:
+            if field in fields:
+                customer[field] = fields[field] or None
+        customer['updated_at'] = self._now()
+        return _document('customer', customer)
+
+    def listCustomerSubscriptions(self, params, data, id):
+        self._get(self.customers, id)
+        return _listing('subscriptions', 'subscription',
+            [self._render_subscription(s) for s in self._page(
+                [s for s in self.subscriptions.itervalues()
+                    if s['customer_id'] == int(id)], params)])
+
+    # Products and components
+
+    def listProducts(self, params, data):
+        return _listing('products', 'product', [self._render_product(p)
+            for p in self._page(self.products.itervalues(), params)])
+
+    def getProduct(self, params, data, id):
+        return _document('product',
+            self._render_product(self._get(self.products, id)))
+
+    def _product_by_handle(self, handle):
+        for product in self.products.itervalues():
+            if product['handle'] == handle:
+                return product
+        return None
+
+    def getProductByHandle(self, params, data, handle):
+        product = self._product_by_handle(handle)
+        if product is None:
+            raise _not_found()
+        return _document('product', self._render_product(product))
+
+    def listProductFamilies(self, params, data):
+        return _listing('product_families', 'product_family',
+            self._page(self.product_families.itervalues(), params))
+
+    def getProductFamily(self, params, data, id):
+        return _document('product_family',
+            self._get(self.product_families, id))
+
+    def listComponents(self, params, data, id):
+        self._get(self.product_families, id)
+        return _listing('components', 'component', self._page(
+            [c for c in self.components.itervalues()
+                if c['product_family_id'] == int(id)], params))
+
+    # Subscriptions
+
+    def _create_subscription(self, customer, product, credit_card=None):
+        now = self._now()
+        period = {'day': 86400}.get(product['interval_unit'], 30 * 86400) * \
+            product['interval']
+        subscription = {
+            'id': self._next_id('subscription'),
+            'state': 'active',
+            'balance_in_cents': 0,
+            'current_period_started_at': now,
+            'current_period_ends_at': _Timestamp(now + period),
+            'next_billing_at': _Timestamp(now + period),
+            'trial_started_at': None,
+            'trial_ended_at': None,
+            'activated_at': now,
+            'expires_at': None,
+            'created_at': now,
+            'updated_at': now,
+            'cancellation_message': None,
+            'customer_id': customer['id'],
+            'product_id': product['id'],
+            'credit_card': None,
+        }
+        if credit_card:
+            subscription['credit_card'] = self._credit_card(credit_card)
+        self.subscriptions[subscription['id']] = subscription
+        self.subscription_components[subscription['id']] = dict(
+            (c['id'], {'allocated_quantity': 0, 'enabled': False,
+                'unit_balance': 0})
+            for c in self.components.itervalues()
+            if c['product_family_id'] == product['product_family_id'])
+        return subscription
+
+    def _credit_card(self, fields):
+        number = str(fields.get('full_number') or '')
+        if not number:
+            raise _invalid('Credit card number: cannot be blank.')
+        card = dict((f, fields.get(f) or None) for f in
+            self.credit_card_fields)
+        card['masked_card_number'] = 'XXXX-XXXX-XXXX-' + number[-4:]
+        card['card_type'] = 'bogus' if number in ('1', '2', '3') else 'visa'
+        return card
+
+    def _product_for(self, fields):
+        if fields.get('product_handle'):
+            product = self._product_by_handle(fields['product_handle'])
+        elif fields.get('product_id'):
+            product = self.products.get(_int(fields['product_id'],
+                'product_id'))
+        else:
+            product = None
+        if product is None:
+            raise _invalid('Product must be specified.')
+        return product
+
+    def _customer_for(self, fields):
+        if fields.get('customer_id'):
+            return self._get(self.customers, fields['customer_id'])
+        if fields.get('customer_reference'):
+            for customer in self.customers.itervalues():
+                if customer['reference'] == fields['customer_reference']:
+                    return customer
+            raise _invalid('Customer reference not found.')
+        attributes = fields.get('customer_attributes') or \
+            fields.get('customer')
+        if isinstance(attributes, dict):
+            return self._create_customer(attributes)
+        raise _invalid('Customer must be specified.')
+
+    def listSubscriptions(self, params, data):
+        return _listing('subscriptions', 'subscription',
+            [self._render_subscription(s)
+                for s in self._page(self.subscriptions.itervalues(), params)])
+
+    def createSubscription(self, params, data):
+        fields = data.get('subscription') or {}
+        product = self._product_for(fields)
+        customer = self._customer_for(fields)
+        credit_card = fields.get('credit_card_attributes')
+        subscription = self._create_subscription(customer, product,
+            credit_card if isinstance(credit_card, dict) else None)
+        return _document('subscription',
+            self._render_subscription(subscription))
+
+    def getSubscription(self, params, data, id):
+        return _document('subscription',
+            self._render_subscription(self._get(self.subscriptions, id)))
+
+    def updateSubscription(self, params, data, id):
+        subscription = self._get(self.subscriptions, id)
+        fields = data.get('subscription') or {}
+        if fields.get('product_handle') or fields.get('product_id'):
+            subscription['product_id'] = self._product_for(fields)['id']
+        if isinstance(fields.get('credit_card_attributes'), dict):
+            subscription['credit_card'] = self._credit_card(
+                fields['credit_card_attributes'])
+        subscription['updated_at'] = self._now()
+        return _document('subscription',
+            self._render_subscription(subscription))
+
+    def cancelSubscription(self, params, data, id):
+        subscription = self._get(self.subscriptions, id)
+        fields = data.get('subscription') or {}
+        subscription['state'] = 'canceled'
+        subscription['cancellation_message'] = \
+            fields.get('cancellation_message') or None
+        subscription['updated_at'] = self._now()
+        return _document('subscription',
+            self._render_subscription(subscription))
+
+    def resetBalance(self, params, data, id):
+        subscription = self._get(self.subscriptions, id)
+        subscription['balance_in_cents'] = 0
+        subscription['updated_at'] = self._now()
+        return _document('subscription',
+            self._render_subscription(subscription))
+
+    def reactivate(self, params, data, id):
+        subscription = self._get(self.subscriptions, id)
+        if subscription['state'] != 'canceled':
+            raise _invalid('Subscription is not canceled.')
+        subscription['state'] = 'active'
+        subscription['updated_at'] = self._now()
+        return _document('subscription',
+            self._render_subscription(subscription))
+
+    # Subscription components and usages
+
+    def _allocation(self, subscription_id, component_id):
+        allocations = self.subscription_components.get(int(subscription_id))
+        if allocations is None or int(component_id) not in allocations:
+            raise _not_found()
+        return allocations[int(component_id)]
+
+    def listSubscriptionComponents(self, params, data, id):
+        self._get(self.subscriptions, id)
+        return _listing('components', 'component',
+            [self._render_subscription_component(int(id), component_id)
+                for component_id in sorted(
+                    self.subscription_components[int(id)])])
+
+    def getSubscriptionComponent(self, params, data, id, component_id):
+        self._allocation(id, component_id)
+        return _document('component',
+            self._render_subscription_component(int(id), int(component_id)))
+
+    def updateSubscriptionComponent(self, params, data, id, component_id):
+        allocation = self._allocation(id, component_id)
+        fields = data.get('component') or {}
+        kind = self.components[int(component_id)]['kind']
+        if kind == 'quantity_based_component' and \
+                'allocated_quantity' in fields:
+            allocation['allocated_quantity'] = _int(
+                fields['allocated_quantity'], 'allocated_quantity')
+        elif kind == 'on_off_component':
+            value = fields.get('enabled', fields.get('allocated_quantity'))
+            allocation['enabled'] = str(value).lower() in ('1', 'true')
+        else:
+            raise _invalid('Component cannot be updated.')
+        self.subscriptions[int(id)]['updated_at'] = self._now()
+        return _document('component',
+            self._render_subscription_component(int(id), int(component_id)))
+
+    def listUsages(self, params, data, id, component_id):
+        self._allocation(id, component_id)
+        return _listing('usages', 'usage', self._page(
+            self.usages.get((int(id), int(component_id)), ()), params))
+
+    def createUsage(self, params, data, id, component_id):
+        allocation = self._allocation(id, component_id)
+        if self.components[int(component_id)]['kind'] != 'metered_component':
+            raise _invalid('Usage can only be recorded for metered components.')
+        fields = data.get('usage') or {}
+        usage = {
+            'id': self._next_id('usage'),
+            'quantity': _int(fields.get('quantity'), 'quantity'),
+            'memo': fields.get('memo') or '',
+            'created_at': self._now(),
+        }
+        allocation['unit_balance'] += usage['quantity']
+        self.usages.setdefault((int(id), int(component_id)), []).append(usage)
+        return _document('usage', usage)
@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+An HTTP/2 transport multiplexing concurrent requests over one connection.
+
+Requires the h2 package (pip install h2):
+
+    session = chargify.session
+    session.transport = ChargifyHTTP2Transport(session.request_host)
+
+Any number of threads may share the transport. Each request is one
+stream; the number of streams in flight is capped by max_streams and by
+the server's SETTINGS_MAX_CONCURRENT_STREAMS, and request bodies are sent
+within the peer's flow control windows.
+'''
+
+import httplib
+import socket
+import ssl
+import threading
+
+from api import ChargifyDeadlineExceeded, ChargifyError, ChargifyTransport, \
+    deadline_passed, decode_body, deadline_timeout
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    h2 = None
+
+# Request headers that are meaningless or forbidden in HTTP/2
+_HOP_HEADERS = ('host', 'connection', 'keep-alive', 'transfer-encoding',
+    'upgrade', 'proxy-connection')
+
+
+class ChargifyHTTP2Error(ChargifyError):
+    """
+    The HTTP/2 connection or a stream on it failed
+    @license    GNU General Public License
+    """
+    pass
+
+
+class _Stream(object):
+
+    def __init__(self):
+        self.status = None
+        self.headers = []
+        self.chunks = []
+        self.error = None
+        self.done = threading.Event()
+
+    def fail(self, error):
+        self.error = error
+        self.done.set()
+
+
+class ChargifyHTTP2Transport(ChargifyTransport):
+    """
+    Sends requests as streams over a single HTTP/2 connection per host
+    @license    GNU General Public License
+    """
+
+    def __init__(self, host, port=443, secure=True, max_streams=100,
+                 timeout=None):
+        if h2 is None:
+            raise ChargifyError('ChargifyHTTP2Transport requires the h2 package')
+        self.host = host
+        self.port = port
+        self.secure = secure
+        self.max_streams = max_streams
+        self.timeout = timeout
+        self._sock = None
+        self._conn = None
+        self._reader = None
+        self._streams = {}
+        # Guards the h2 state machine and writes to the socket
+        self._lock = threading.RLock()
+        # Signalled when a stream finishes or a flow control window opens
+        self._changed = threading.Condition(self._lock)
+
+    def _connect(self):
+        sock = socket.create_connection((self.host, self.port),
+            deadline_timeout(self.timeout))
+        if self.secure:
+            context = ssl.create_default_context()
+            context.set_alpn_protocols(['h2'])
+            sock = context.wrap_socket(sock, server_hostname=self.host)
+            if sock.selected_alpn_protocol() != 'h2':
+                sock.close()
+                raise ChargifyHTTP2Error('%s does not speak HTTP/2' %
+                    self.host)
+        # The reader thread blocks in recv for as long as the connection
+        # lives, timeouts apply per request instead
+        sock.settimeout(None)
+
+        conn = h2.connection.H2Connection(config=h2.config.H2Configuration(
+            client_side=True, header_encoding='utf-8'))
+        conn.initiate_connection()
+        sock.sendall(conn.data_to_send())
+
+        self._sock, self._conn = sock, conn
+        self._reader = threading.Thread(target=self._read, args=(sock, conn),
+            name='pychargify-h2-reader')
+        self._reader.daemon = True
+        self._reader.start()
+
+    def _stream_limit(self):
+        return min(self.max_streams,
+            self._conn.remote_settings.max_concurrent_streams)
+
+    def _flush(self):
+        data = self._conn.data_to_send()
+        if data:
+            self._sock.sendall(data)
+
+    def _read(self, sock, conn):
+        error = None
+        try:
+            while True:
+                data = sock.recv(65535)
+                if not data:
+                    error = ChargifyHTTP2Error('Connection closed')
+                    break
+                self._lock.acquire()
+                try:
+                    if self._conn is not conn:
+                        break
+                    for event in conn.receive_data(data):
+                        self._handle(event)
+                    if self._conn is conn:
+                        self._flush()
+                    self._changed.notify_all()
+                finally:
+                    self._lock.release()
+                if self._conn is not conn:
+                    break
+        except Exception, e:
+            if self._conn is not conn:
+                # Closed underneath us by close() or _reset()
+                return
+            error = ChargifyHTTP2Error(str(e))
+
+        self._lock.acquire()
+        try:
+            if self._conn is conn:
+                self._reset(error or ChargifyHTTP2Error('Connection closed'))
+        finally:
+            self._lock.release()
+
+    def _handle(self, event):
+        stream = self._streams.get(getattr(event, 'stream_id', None))
+        if isinstance(event, h2.events.ResponseReceived):
+            if stream is None:
+                return
+            stream.headers = event.headers
+            for name, value in event.headers:
+                if name == ':status':
+                    stream.status = int(value)
+        elif isinstance(event, h2.events.DataReceived):
+            if stream is not None:
+                stream.chunks.append(event.data)
+            self._conn.acknowledge_received_data(
+                event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            if stream is not None:
+                stream.done.set()
+        elif isinstance(event, h2.events.StreamReset):
+            if stream is not None:
+                stream.fail(ChargifyHTTP2Error('Stream reset with error %s'
+                    % event.error_code))
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self._reset(ChargifyHTTP2Error(
+                'Connection terminated with error %s' % event.error_code))
+
+    def _reset(self, error):
+        """
+        Drop the connection, failing every stream still in flight
+        """
+        streams, self._streams = self._streams, {}
+        sock, self._sock, self._conn = self._sock, None, None
+        for stream in streams.itervalues():
+            stream.fail(error)
+        if sock is not None:
+            try:
+                sock.close()
+            except socket.error:
+                pass
+        self._changed.notify_all()
+
+    def _open_stream(self, method, url, body, headers):
+        """
+        Wait for a free stream slot and send the request headers
+        """
+        self._lock.acquire()
+        try:
+            if self._conn is None:
+                self._connect()
+            while len(self._streams) >= self._stream_limit():
+                self._changed.wait(deadline_timeout())
+                if self._conn is None:
+                    self._connect()
+            conn = self._conn
+            stream_id = conn.get_next_available_stream_id()
+            request_headers = [
+                (':method', method),
+                (':scheme', self.secure and 'https' or 'http'),
+                (':authority', self.host),
+                (':path', url),
+            ] + [(name.lower(), str(value))
+                for name, value in (headers or {}).iteritems()
+                if name.lower() not in _HOP_HEADERS]
+            if body:
+                request_headers.append(('content-length', str(len(body))))
+            stream = self._streams[stream_id] = _Stream()
+            conn.send_headers(stream_id, request_headers, end_stream=not body)
+            self._flush()
+            return conn, stream_id, stream
+        finally:
+            self._lock.release()
+
+    def _send_body(self, conn, stream_id, stream, body):
+        """
+        Send the request body as the flow control windows allow
+        """
+        offset = 0
+        self._lock.acquire()
+        try:
+            while offset < len(body):
+                if self._conn is not conn or stream.done.is_set():
+                    return
+                window = min(conn.local_flow_control_window(stream_id),
+                    conn.max_outbound_frame_size)
+                if window <= 0:
+                    self._changed.wait(deadline_timeout())
+                    continue
+                chunk = body[offset:offset + window]
+                offset += len(chunk)
+                conn.send_data(stream_id, chunk,
+                    end_stream=offset >= len(body))
+                self._flush()
+        finally:
+            self._lock.release()
+
+    def request(self, method, url, body=None, headers=None):
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        conn, stream_id, stream = self._open_stream(method, url, body,
+            headers)
+        try:
+            if body:
+                self._send_body(conn, stream_id, stream, body)
+            if not stream.done.wait(deadline_timeout(self.timeout)):
+                self._lock.acquire()
+                try:
+                    if self._conn is conn:
+                        conn.reset_stream(stream_id)
+                        self._flush()
+                finally:
+                    self._lock.release()
+                if deadline_passed():
+                    raise ChargifyDeadlineExceeded('Deadline exceeded '
+                        'waiting for %s %s' % (method, url))
+                raise ChargifyHTTP2Error('Timed out waiting for %s %s' %
+                    (method, url))
+        finally:
+            self._lock.acquire()
+            try:
+                self._streams.pop(stream_id, None)
+                self._changed.notify_all()
+            finally:
+                self._lock.release()
+
+        if stream.error is not None:
+            raise stream.error
+        encoding = dict(stream.headers).get('content-encoding')
+        return stream.status, httplib.responses.get(stream.status, ''), \
+            decode_body(''.join(stream.chunks), encoding)
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            reader = self._reader
+            if self._conn is not None:
+                self._conn.close_connection()
+                try:
+                    self._flush()
+                except socket.error:
+                    pass
+                self._reset(ChargifyHTTP2Error('Transport closed'))
+        finally:
+            self._lock.release()
+        if reader is not None and reader is not threading.current_thread():
+            reader.join(1)
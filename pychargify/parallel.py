@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Parsing of large listings in a pool of worker processes.
+
+    chargify = Chargify('YOUR-API-KEY', 'YOUR-SUB-DOMAIN',
+        parser=ChargifyParserPool(processes=4, min_size=1 << 20))
+
+Listing responses of at least min_size characters are split into chunks
+of whole records that the workers parse into compact records, plain
+dictionaries that are cheap to pickle. The calling process only turns
+those into resource objects, so it spends little time holding the GIL.
+Smaller responses are parsed in-process as usual.
+'''
+
+import multiprocessing
+import re
+import threading
+
+from xml.dom import minidom
+
+from api import ChargifyDeadlineExceeded, ChargifyResourceType, deadline_iter
+
+XML_HEADER = '<?xml version="1.0" encoding="utf-8"?>'
+
+
+def _parse_chunk(args):
+    """
+    Parse a chunk of records in a worker, returning compact records
+    """
+    obj_type, node_name, chunk = args
+    resource = ChargifyResourceType.resources[obj_type]
+    dom = minidom.parseString('%s<records>%s</records>' % (XML_HEADER,
+        chunk))
+    return [resource._compactNode(node)
+        for node in dom.getElementsByTagName(node_name)]
+
+
+def split_records(xml, node_name):
+    """
+    Return the (start, end) offsets of each top level node_name element
+    of a listing
+    """
+    tag_rx = re.compile(r'<(/?)%s(?=[\s/>])([^>]*)>' % re.escape(node_name))
+    spans = []
+    depth = 0
+    start = None
+    for match in tag_rx.finditer(xml):
+        if match.group(1):
+            depth -= 1
+            if depth == 0:
+                spans.append((start, match.end()))
+        elif match.group(2).endswith('/'):
+            if depth == 0:
+                spans.append((match.start(), match.end()))
+        else:
+            if depth == 0:
+                start = match.start()
+            depth += 1
+    return spans
+
+
+class ChargifyParserPool(object):
+    """
+    Parses listings of at least min_size characters in processes worker
+    processes, started on first use. Each worker task gets about
+    chunk_size characters of whole records.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, processes=None, min_size=1 << 20, chunk_size=1 << 18):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.min_size = min_size
+        self.chunk_size = chunk_size
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def _get_pool(self):
+        self._lock.acquire()
+        try:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.processes)
+            return self._pool
+        finally:
+            self._lock.release()
+
+    def chunks(self, xml, node_name):
+        """
+        Group the records of a listing into utf-8 encoded chunks
+        """
+        chunks = []
+        first = last = None
+        for start, end in split_records(xml, node_name):
+            if first is None:
+                first = start
+            elif end - first > self.chunk_size:
+                chunks.append(xml[first:last])
+                first = start
+            last = end
+        if first is not None:
+            chunks.append(xml[first:last])
+        return [chunk.encode('utf-8') if isinstance(chunk, unicode)
+            else chunk for chunk in chunks]
+
+    def records(self, xml, obj_type, node_name):
+        """
+        Parse a listing into compact records, in listing order. When the
+        current ChargifyDeadline passes first the workers are stopped,
+        dropping the chunks still queued, and restarted on next use.
+        """
+        tasks = [(obj_type, node_name, chunk)
+            for chunk in self.chunks(xml, node_name)]
+        if not tasks:
+            return []
+        result = []
+        try:
+            for records in deadline_iter(self._get_pool().imap(_parse_chunk,
+                    tasks)):
+                result.extend(records)
+        except ChargifyDeadlineExceeded:
+            self.close()
+            raise
+        return result
+
+    def parse(self, xml, obj_type, node_name, session):
+        """
+        Parse a listing into resource objects bound to session
+        """
+        resource = ChargifyResourceType.resources[obj_type]
+        return [resource._fromCompact(record, session)
+            for record in self.records(xml, obj_type, node_name)]
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            pool, self._pool = self._pool, None
+        finally:
+            self._lock.release()
+        if pool is not None:
+            pool.terminate()
+            pool.join()
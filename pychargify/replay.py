@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Record and replay of Chargify API responses.
+
+Record against the live API once:
+
+    chargify = Chargify('YOUR-API-KEY', 'YOUR-SUB-DOMAIN')
+    chargify.session.transport = ChargifyRecordingTransport(
+        chargify.session.pool, 'responses.chargify')
+
+and serve the archive back without any network access:
+
+    chargify.session.transport = ChargifyReplayTransport('responses.chargify')
+
+The archive is append-only: a magic header followed by one record per
+response, each a fixed size header (status, method, url, reason and body
+lengths) followed by the method, url, reason and body bytes.
+'''
+
+import mmap
+import os
+import struct
+import threading
+
+from api import ChargifyError, ChargifyTransport
+
+MAGIC = 'PYCHARGIFY-REPLAY-1\n'
+
+_RECORD = struct.Struct('>HHHHQ')
+
+
+class ChargifyReplayMissing(ChargifyError):
+    """
+    The replayed archive holds no response for the request
+    @license    GNU General Public License
+    """
+    pass
+
+
+class ChargifyRecordingTransport(ChargifyTransport):
+    """
+    Passes requests on to another transport and appends every response
+    to an archive
+    @license    GNU General Public License
+    """
+
+    def __init__(self, transport, path):
+        self.transport = transport
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+            self._file.flush()
+
+    def request(self, method, url, body=None, headers=None):
+        status, reason, data = self.transport.request(method, url, body,
+            headers)
+        self.append(method, url, status, reason, data)
+        return status, reason, data
+
+    def append(self, method, url, status, reason, data):
+        """
+        Write one response record to the archive
+        """
+        reason = reason or ''
+        record = ''.join([
+            _RECORD.pack(status, len(method), len(url), len(reason),
+                len(data)),
+            method, url, reason, data])
+        self._lock.acquire()
+        try:
+            self._file.write(record)
+            self._file.flush()
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._file.close()
+
+
+class ChargifyReplayTransport(ChargifyTransport):
+    """
+    Serves responses from a recorded archive through a read only memory
+    map. Responses recorded several times for the same method and url are
+    served round robin.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+        if size < len(MAGIC):
+            raise ChargifyError('%s is not a pychargify replay archive' % path)
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ChargifyError('%s is not a pychargify replay archive' % path)
+        self._index = self._build_index(size)
+        self._served = {}
+        self._lock = threading.Lock()
+
+    def _build_index(self, size):
+        """
+        Map (method, url) to the (status, reason, offset, length) of each
+        recorded body. Only the record headers are read, bodies are skipped.
+        """
+        index = {}
+        buf = self._map
+        offset = len(MAGIC)
+        while offset + _RECORD.size <= size:
+            status, method_len, url_len, reason_len, body_len = \
+                _RECORD.unpack_from(buf, offset)
+            offset += _RECORD.size
+            method = buf[offset:offset + method_len]
+            offset += method_len
+            url = buf[offset:offset + url_len]
+            offset += url_len
+            reason = buf[offset:offset + reason_len]
+            offset += reason_len
+            if offset + body_len > size:
+                # A record truncated by an interrupted recording
+                break
+            index.setdefault((method, url), []).append(
+                (status, reason, offset, body_len))
+            offset += body_len
+        return index
+
+    def __len__(self):
+        return sum(len(v) for v in self._index.itervalues())
+
+    def urls(self):
+        return self._index.keys()
+
+    def request(self, method, url, body=None, headers=None):
+        entries = self._index.get((method, url))
+        if not entries:
+            raise ChargifyReplayMissing('%s %s' % (method, url))
+
+        key = (method, url)
+        self._lock.acquire()
+        try:
+            served = self._served.get(key, 0)
+            self._served[key] = served + 1
+        finally:
+            self._lock.release()
+
+        status, reason, offset, length = entries[served % len(entries)]
+        return status, reason, self._map[offset:offset + length]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Local validation of customer and credit card records, so that a bulk
+import only sends records Chargify is going to accept:
+
+    result = validateCustomers(rows)
+    for index, record, errors in result.rejected():
+        log.warning('Row %d: %s' % (index, errors))
+    for record in result.valid():
+        ...
+
+Records are dictionaries or ChargifyCustomer / ChargifyCreditCard
+objects. Each record gets a list of (field, message) diagnostics, empty
+when it passed. Card number Luhn checks and expiration dates are checked
+for the whole batch at once with numpy when it is installed.
+'''
+
+import datetime
+import re
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+CUSTOMER_REQUIRED = ('first_name', 'last_name', 'email')
+CREDIT_CARD_REQUIRED = ('full_number', 'expiration_month', 'expiration_year')
+
+# Card numbers are at most this many digits long
+MAX_CARD_DIGITS = 19
+
+# How many years ahead an expiration date may lie
+MAX_EXPIRATION_YEARS = 20
+
+_email_rx = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s.]+$')
+_card_rx = re.compile(r'^\d{12,19}$')
+_separators_rx = re.compile(r'[\s-]')
+
+# ISO 3166-1 alpha-2
+COUNTRIES = frozenset('''
+    AD AE AF AG AI AL AM AO AQ AR AS AT AU AW AX AZ BA BB BD BE BF BG BH BI
+    BJ BL BM BN BO BQ BR BS BT BV BW BY BZ CA CC CD CF CG CH CI CK CL CM CN
+    CO CR CU CV CW CX CY CZ DE DJ DK DM DO DZ EC EE EG EH ER ES ET FI FJ FK
+    FM FO FR GA GB GD GE GF GG GH GI GL GM GN GP GQ GR GS GT GU GW GY HK HM
+    HN HR HT HU ID IE IL IM IN IO IQ IR IS IT JE JM JO JP KE KG KH KI KM KN
+    KP KR KW KY KZ LA LB LC LI LK LR LS LT LU LV LY MA MC MD ME MF MG MH MK
+    ML MM MN MO MP MQ MR MS MT MU MV MW MX MY MZ NA NC NE NF NG NI NL NO NP
+    NR NU NZ OM PA PE PF PG PH PK PL PM PN PR PS PT PW PY QA RE RO RS RU RW
+    SA SB SC SD SE SG SH SI SJ SK SL SM SN SO SR SS ST SV SX SY SZ TC TD TF
+    TG TH TJ TK TL TM TN TO TR TT TV TW TZ UA UG UM US UY UZ VA VC VE VG VI
+    VN VU WF WS YE YT ZA ZM ZW
+'''.split())
+
+# State and province codes of the countries Chargify requires them for
+STATES = {
+    'US': frozenset('''
+        AL AK AZ AR CA CO CT DE DC FL GA HI ID IL IN IA KS KY LA ME MD MA MI
+        MN MS MO MT NE NV NH NJ NM NY NC ND OH OK OR PA RI SC SD TN TX UT VT
+        VA WA WV WI WY AS GU MP PR UM VI AA AE AP
+    '''.split()),
+    'CA': frozenset('AB BC MB NB NL NS NT NU ON PE QC SK YT'.split()),
+}
+
+
+class ChargifyValidationResult(object):
+    """
+    The records of a batch with the diagnostics of each, in batch order
+    @license    GNU General Public License
+    """
+
+    def __init__(self, records, errors):
+        self.records = records
+        self.errors = errors
+
+    def __len__(self):
+        return len(self.records)
+
+    def isValid(self, index):
+        return not self.errors[index]
+
+    def valid(self):
+        """
+        The records without diagnostics
+        """
+        return [record for record, errors in zip(self.records, self.errors)
+            if not errors]
+
+    def rejected(self):
+        """
+        (index, record, diagnostics) of every record that failed
+        """
+        return [(i, record, errors) for i, (record, errors) in
+            enumerate(zip(self.records, self.errors)) if errors]
+
+
+def _get(record, name):
+    if isinstance(record, dict):
+        value = record.get(name)
+    else:
+        value = record.__dict__.get(name)
+    if isinstance(value, basestring):
+        value = value.strip()
+    return value
+
+
+def _text(value):
+    """
+    A value as text, for fields parsed from JSON or CSV as numbers
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    return unicode(value)
+
+
+def _as_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _check_required(records, errors, fields):
+    for record, diagnostics in zip(records, errors):
+        for name in fields:
+            value = _get(record, name)
+            if value is None or value == '':
+                diagnostics.append((name, 'is required'))
+
+
+def _check_location(records, errors, country_field, state_field):
+    for record, diagnostics in zip(records, errors):
+        country = _get(record, country_field)
+        if country is None or country == '':
+            continue
+        country = _text(country).upper()
+        if country not in COUNTRIES:
+            diagnostics.append((country_field,
+                'is not an ISO 3166 country code'))
+            continue
+        state = _get(record, state_field)
+        states = STATES.get(country)
+        if states is not None and state not in (None, '') and \
+                _text(state).upper() not in states:
+            diagnostics.append((state_field, 'is not a state of %s' %
+                country))
+
+
+def luhn_valid(numbers):
+    """
+    Whether each of a list of digit strings passes the Luhn check
+    """
+    if numpy is None or not numbers:
+        return [_luhn(number) for number in numbers]
+    # Right align every number in a fixed width row of digits, the
+    # leading zeros do not change the checksum
+    digits = numpy.frombuffer(''.join(number.rjust(MAX_CARD_DIGITS, '0')
+        for number in numbers), dtype=numpy.uint8).reshape(
+            len(numbers), MAX_CARD_DIGITS) - ord('0')
+    doubled = digits[:, -2::-2] * 2
+    total = digits[:, -1::-2].sum(axis=1) + doubled.sum(axis=1) - \
+        9 * (doubled > 9).sum(axis=1)
+    return (total % 10 == 0).tolist()
+
+
+def _luhn(number):
+    total = 0
+    for i, digit in enumerate(reversed(number)):
+        digit = ord(digit) - 48
+        if i % 2:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return total % 10 == 0
+
+
+def expiration_errors(months, years, today):
+    """
+    A message, or None, for each (month, year) pair of integers, None
+    standing for missing values. Two digit years are taken as 20xx.
+    """
+    if numpy is None:
+        return [_expiration_error(month, year, today)
+            for month, year in zip(months, years)]
+    missing = numpy.array([m is None or y is None
+        for m, y in zip(months, years)], dtype=bool)
+    month = numpy.array([m or 0 for m in months], dtype=numpy.int64)
+    year = numpy.array([y or 0 for y in years], dtype=numpy.int64)
+    year = numpy.where(year < 100, year + 2000, year)
+    bad_month = (month < 1) | (month > 12)
+    expired = year * 12 + month < today.year * 12 + today.month
+    too_far = year > today.year + MAX_EXPIRATION_YEARS
+
+    messages = []
+    for i in xrange(len(months)):
+        if missing[i]:
+            messages.append(None)
+        elif bad_month[i]:
+            messages.append('month must be between 1 and 12')
+        elif expired[i]:
+            messages.append('card has expired')
+        elif too_far[i]:
+            messages.append('year is too far in the future')
+        else:
+            messages.append(None)
+    return messages
+
+
+def _expiration_error(month, year, today):
+    if month is None or year is None:
+        return None
+    if year < 100:
+        year += 2000
+    if not 1 <= month <= 12:
+        return 'month must be between 1 and 12'
+    if (year, month) < (today.year, today.month):
+        return 'card has expired'
+    if year > today.year + MAX_EXPIRATION_YEARS:
+        return 'year is too far in the future'
+    return None
+
+
+def validateCustomers(records):
+    """
+    Check required fields, email format and country and state codes of a
+    batch of customer records
+    """
+    records = list(records)
+    errors = [[] for record in records]
+    _check_required(records, errors, CUSTOMER_REQUIRED)
+    for record, diagnostics in zip(records, errors):
+        email = _get(record, 'email')
+        if email not in (None, '') and not _email_rx.match(_text(email)):
+            diagnostics.append(('email', 'is not a valid email address'))
+    _check_location(records, errors, 'country', 'state')
+    return ChargifyValidationResult(records, errors)
+
+
+def validateCreditCards(records, today=None):
+    """
+    Check required fields, card numbers, expiration dates and billing
+    country and state codes of a batch of credit card records. today
+    defaults to the current date.
+    """
+    records = list(records)
+    errors = [[] for record in records]
+    today = today or datetime.date.today()
+    _check_required(records, errors, CREDIT_CARD_REQUIRED)
+
+    # Card numbers of the right shape get the Luhn check as one batch
+    numbers = []
+    checked = []
+    for i, record in enumerate(records):
+        number = _get(record, 'full_number')
+        if number is None or number == '':
+            continue
+        number = _separators_rx.sub('', _text(number))
+        if not _card_rx.match(number):
+            errors[i].append(('full_number', 'must be 12 to 19 digits'))
+        else:
+            numbers.append(str(number))
+            checked.append(i)
+    for i, ok in zip(checked, luhn_valid(numbers)):
+        if not ok:
+            errors[i].append(('full_number', 'fails the Luhn check'))
+
+    months = []
+    years = []
+    for record, diagnostics in zip(records, errors):
+        month, year = [_get(record, name) for name in
+            ('expiration_month', 'expiration_year')]
+        for name, value in (('expiration_month', month),
+                ('expiration_year', year)):
+            if value not in (None, '') and _as_int(value) is None:
+                diagnostics.append((name, 'must be a number'))
+        months.append(_as_int(month))
+        years.append(_as_int(year))
+    for diagnostics, message in zip(errors,
+            expiration_errors(months, years, today)):
+        if message:
+            diagnostics.append(('expiration_month', message))
+
+    _check_location(records, errors, 'billing_country', 'billing_state')
+    return ChargifyValidationResult(records, errors)
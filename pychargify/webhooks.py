@@ -0,0 +1,240 @@
+# -*- coding: utf-8 -*-
+'''
+This program is free software; you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation; either version 2 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program; if not, write to the Free Software
+Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301  USA
+
+
+Chargify webhook verification and decoding.
+
+    webhooks = ChargifyWebhooks('SITE-SHARED-KEY', chargify.session)
+    event = webhooks.handle(request.body,
+        request.headers['X-Chargify-Webhook-Signature-Hmac-Sha-256'])
+    event.subscription.state
+
+Payloads are decoded straight into resource objects. The API is only
+called back when a payload carries nothing but the id of an object.
+'''
+
+import datetime
+import hashlib
+import hmac
+import re
+import threading
+import urlparse
+
+from multiprocessing.pool import ThreadPool
+
+import api
+import iso8601
+
+SIGNATURE_HEADER = 'X-Chargify-Webhook-Signature-Hmac-Sha-256'
+
+# Payload keys decoded into resource objects
+RESOURCE_TYPES = {
+    'subscription': 'ChargifySubscription',
+    'customer': 'ChargifyCustomer',
+    'product': 'ChargifyProduct',
+    'product_family': 'ChargifyProductFamily',
+    'credit_card': 'ChargifyCreditCard',
+    'component': 'ChargifyProductFamilyComponent',
+}
+
+_key_rx = re.compile(r'\[([^\]]*)\]')
+_tz_rx = re.compile(r' ?([+-]\d\d):?(\d\d)$')
+
+
+class ChargifyWebhookSignatureError(api.ChargifyError):
+    """
+    The webhook signature does not match the payload
+    @license    GNU General Public License
+    """
+    pass
+
+
+def _parse_datetime(value):
+    """
+    Parse the timestamps found in webhook payloads, either ISO 8601 or
+    the '2012-09-09 11:38:32 -0400' form, into local naive datetimes as
+    the XML parser does. Unparseable values are returned unchanged.
+    """
+    text = _tz_rx.sub(r'\1:\2', value.strip()).replace(' ', 'T', 1)
+    try:
+        return datetime.datetime.fromtimestamp(iso8601.parse(text))
+    except ValueError:
+        return value
+
+
+def decode_form(body):
+    """
+    Decode a form encoded payload such as
+    payload[subscription][customer][email]=... into nested dictionaries
+    """
+    result = {}
+    for key, value in urlparse.parse_qsl(body, keep_blank_values=True):
+        bracket = key.find('[')
+        if bracket == -1:
+            path = [key]
+        else:
+            path = [key[:bracket]] + _key_rx.findall(key[bracket:])
+        node = result
+        for part in path[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                child = node[part] = {}
+            node = child
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+        node[path[-1]] = value
+    return result
+
+
+class ChargifyWebhookEvent(object):
+    """
+    A decoded webhook. Resource objects found in the payload are
+    available as attributes named after their payload key, e.g.
+    event.subscription or event.customer.
+    @license    GNU General Public License
+    """
+
+    def __init__(self, id, event, payload):
+        self.id = id
+        self.event = event
+        self.payload = payload
+
+    def __repr__(self):
+        return '<ChargifyWebhookEvent %s %s>' % (self.id, self.event)
+
+
+class ChargifyWebhooks(object):
+    """
+    Verifies and decodes webhooks signed with the site's shared key
+    @license    GNU General Public License
+    """
+
+    def __init__(self, shared_key, session=None, workers=4):
+        # Without a session decoded objects share one that has no
+        # credentials, and payloads holding only an id are not refetched
+        self.session = session
+        self._object_session = session or api.ChargifySession(None, None)
+        self.workers = workers
+        self._mac = hmac.new(shared_key, digestmod=hashlib.sha256)
+        self._pool = None
+        self._lock = threading.Lock()
+
+    def sign(self, body):
+        mac = self._mac.copy()
+        mac.update(body)
+        return mac.hexdigest()
+
+    def verify(self, body, signature):
+        if not signature:
+            return False
+        return hmac.compare_digest(self.sign(body), str(signature).lower())
+
+    def verifyMany(self, items):
+        """
+        Verify a batch of (body, signature) pairs, returning a list of
+        booleans in the same order
+        """
+        return [self.verify(body, signature) for body, signature in items]
+
+    def decode(self, body, content_type=None):
+        """
+        Decode a form or JSON encoded webhook into a ChargifyWebhookEvent
+        """
+        if (content_type and 'json' in content_type) or \
+                body.lstrip()[:1] == '{':
+            data = api.json.loads(body)
+        else:
+            data = decode_form(body)
+
+        event = ChargifyWebhookEvent(data.get('id'), data.get('event'),
+            data.get('payload') or {})
+        for key, value in event.payload.iteritems():
+            if key in RESOURCE_TYPES and isinstance(value, dict):
+                setattr(event, key, self._build(RESOURCE_TYPES[key], value))
+        return event
+
+    def _build(self, obj_type, data):
+        """
+        Build a resource object from a payload dictionary, refetching it
+        when the payload only holds its id
+        """
+        constructor = getattr(api, obj_type)
+        if self.session is not None and data.keys() == ['id'] and \
+                getattr(constructor.Meta, 'listing', None):
+            return constructor(session=self.session).getById(data['id'])
+
+        obj = constructor(session=self._object_session)
+        for key, value in data.iteritems():
+            # Payloads cannot set the session or other internal state
+            if key.startswith('_') or key in constructor.__ignore__:
+                continue
+            field = constructor.__fields__.get(key)
+            nested_type = constructor.__attribute_types__.get(key,
+                RESOURCE_TYPES.get(key))
+            if isinstance(value, dict) and nested_type:
+                value = self._build(nested_type, value)
+            elif isinstance(value, list) and nested_type:
+                value = [self._build(nested_type, v) for v in value
+                    if isinstance(v, dict)]
+            elif isinstance(value, basestring) and key.endswith('_at') \
+                    and value:
+                value = _parse_datetime(value)
+            elif isinstance(value, basestring):
+                if field is not None:
+                    value = field.decode(value)
+            elif value is not None and \
+                    isinstance(field, api.ChargifyStringField):
+                value = unicode(value)
+            setattr(obj, key, value)
+        obj._markClean()
+        return obj
+
+    def handle(self, body, signature, content_type=None):
+        """
+        Verify and decode one webhook, raising
+        ChargifyWebhookSignatureError when the signature does not match
+        """
+        if not self.verify(body, signature):
+            raise ChargifyWebhookSignatureError()
+        return self.decode(body, content_type)
+
+    def handleMany(self, items):
+        """
+        Verify and decode a batch of (body, signature) pairs. Webhooks
+        with a bad signature come back as None.
+        """
+        return [self.decode(body) if ok else None
+            for (body, signature), ok in zip(items, self.verifyMany(items))]
+
+    def handleAsync(self, body, signature, content_type=None, callback=None):
+        """
+        Handle a webhook on a worker thread, returning an AsyncResult so
+        the caller is never blocked by a refetch
+        """
+        self._lock.acquire()
+        try:
+            if self._pool is None:
+                self._pool = ThreadPool(self.workers)
+        finally:
+            self._lock.release()
+        return self._pool.apply_async(api.bind_deadline(self.handle),
+            (body, signature, content_type), callback=callback)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of resource objects against ChargifyFakeBackend.
+
+    python -m unittest discover -s tests -t .
+'''
+
+import unittest
+
+from pychargify.api import Chargify
+from pychargify.fake import ChargifyFakeBackend
+
+
+class RecordingTransport(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.requests = []
+
+    def request(self, method, url, body=None, headers=None):
+        self.requests.append((method, url, body))
+        return self.backend.request(method, url, body, headers)
+
+
+class DirtyTrackingTest(unittest.TestCase):
+
+    def setUp(self):
+        fake = ChargifyFakeBackend()
+        family = fake.addProductFamily(name='Plans', handle='plans')
+        product = fake.addProduct(family, name='Basic', handle='basic',
+            price_in_cents=1000)
+        customer = fake.addCustomer(first_name='John', last_name='Doe',
+            email='john@example.com')
+        fake.addSubscription(customer, product)
+        self.transport = RecordingTransport(fake)
+        self.chargify = Chargify('key', 'subdomain', transport=self.transport)
+
+    def writes(self):
+        return [r for r in self.transport.requests if r[0] != 'GET']
+
+    def test_save_cleans_nested_objects(self):
+        subscription = self.chargify.Subscriptions.getAll()[0]
+        subscription.customer.first_name = 'Jane'
+        self.assertTrue(subscription.isDirty())
+
+        saved, result = subscription.save()
+        self.assertTrue(saved)
+        self.assertFalse(subscription.isDirty())
+        self.assertFalse(subscription.customer.isDirty())
+        self.assertEqual(len(self.writes()), 1)
+        self.assertTrue('<first_name>Jane</first_name>' in
+            self.writes()[0][2])
+
+        # Nothing changed since, so nothing is sent
+        self.assertEqual(subscription.save(), (True, None))
+        self.assertEqual(len(self.writes()), 1)
+
+    def test_unit_of_work_cleans_nested_objects(self):
+        subscription = self.chargify.Subscriptions.getAll()[0]
+        subscription.customer.first_name = 'Jane'
+        uow = self.chargify.UnitOfWork()
+        uow.add(subscription)
+        self.assertTrue(uow.flush()[0][1])
+        self.assertFalse(subscription.isDirty())
+
+        uow.add(subscription)
+        self.assertEqual(uow.flush(), [(subscription, True, None)])
+        self.assertEqual(len(self.writes()), 1)
+
+    def test_thaw_keeps_nested_changes(self):
+        subscription = self.chargify.Subscriptions.getAll()[0]
+        subscription.customer.first_name = 'Jane'
+        thawed = subscription.freeze().thaw()
+        self.assertTrue(thawed.customer.isDirty())
+        self.assertEqual(thawed._changedFields(), ['customer'])
+
+
+
+class UnitOfWorkTest(unittest.TestCase):
+
+    def setUp(self):
+        fake = ChargifyFakeBackend()
+        family = fake.addProductFamily(name='Plans', handle='plans')
+        product = fake.addProduct(family, name='Basic', handle='basic',
+            price_in_cents=1000)
+        customer = fake.addCustomer(first_name='John', last_name='Doe',
+            email='john@example.com')
+        fake.addSubscription(customer, product)
+        self.transport = RecordingTransport(fake)
+        self.chargify = Chargify('key', 'subdomain', transport=self.transport)
+
+    def test_tracked_nested_change_is_sent(self):
+        subscription = self.chargify.Subscriptions.getAll()[0]
+        uow = self.chargify.UnitOfWork()
+        uow.track(subscription)
+        subscription.customer.first_name = 'Jane'
+        self.assertEqual(uow.changedFields(subscription), ['customer'])
+
+        obj, saved, result = uow.flush()[0]
+        self.assertTrue(saved)
+        self.assertTrue(result is not None)
+        writes = [r for r in self.transport.requests if r[0] != 'GET']
+        self.assertEqual(len(writes), 1)
+        self.assertTrue('<first_name>Jane</first_name>' in writes[0][2])
+
+    def test_tracked_unchanged_object_is_skipped(self):
+        subscription = self.chargify.Subscriptions.getAll()[0]
+        uow = self.chargify.UnitOfWork()
+        uow.track(subscription)
+        self.assertEqual(uow.flush(), [(subscription, True, None)])
+        self.assertEqual([r for r in self.transport.requests
+            if r[0] != 'GET'], [])
+
+    def test_objects_are_added_once_in_order(self):
+        uow = self.chargify.UnitOfWork()
+        customers = [self.chargify.Customer() for i in range(20000)]
+        for customer in customers + customers:
+            uow.add(customer)
+        self.assertEqual(len(uow._objects), 20000)
+        self.assertTrue(all(a is b for a, b in zip(uow._objects, customers)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the circuit breaker state machine, driven by a fake clock.
+
+    python -m unittest discover -s tests -t .
+'''
+
+import socket
+import unittest
+
+from pychargify.api import ChargifyDeadline, ChargifyDeadlineExceeded
+from pychargify.breaker import CLOSED, HALF_OPEN, OPEN, \
+    ChargifyCircuitBreaker, ChargifyCircuitOpen
+
+URL = '/subscriptions/1.xml'
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.breaker = ChargifyCircuitBreaker(error_rate=0.5, slow_rate=0.5,
+            slow_threshold=2.0, window=10, min_requests=4, reset_timeout=30.0,
+            clock=self.clock)
+
+    def ok(self, elapsed=0.1):
+        def send():
+            self.clock.now += elapsed
+            return (200, 'OK', '')
+        return self.breaker.call(URL, send)
+
+    def server_error(self):
+        return self.breaker.call(URL, lambda: (503, 'Unavailable', ''))
+
+    def fail(self, error=None):
+        def send():
+            raise error or socket.error('connection refused')
+        self.assertRaises(Exception, self.breaker.call, URL, send)
+
+    def state(self):
+        return self.breaker.state(URL)
+
+    def open_circuit(self):
+        for i in range(4):
+            self.fail()
+        self.assertEqual(self.state(), OPEN)
+
+    def test_opens_on_error_rate(self):
+        self.ok()
+        self.ok()
+        self.fail()
+        self.assertEqual(self.state(), CLOSED)
+        self.server_error()
+        self.assertEqual(self.state(), OPEN)
+        self.assertRaises(ChargifyCircuitOpen, self.ok)
+
+    def test_stays_closed_below_error_rate(self):
+        for i in range(3):
+            self.ok()
+        self.fail()
+        self.ok()
+        self.assertEqual(self.state(), CLOSED)
+
+    def test_opens_on_slow_rate(self):
+        self.ok()
+        self.ok()
+        self.ok(elapsed=2.5)
+        self.assertEqual(self.state(), CLOSED)
+        self.ok(elapsed=3.0)
+        self.assertEqual(self.state(), OPEN)
+
+    def test_families_have_their_own_circuits(self):
+        self.open_circuit()
+        self.assertEqual(self.breaker.state('/customers/1.xml'), CLOSED)
+        self.assertEqual(self.breaker.state('/subscriptions/2/components.xml'),
+            CLOSED)
+
+    def test_single_probe_when_half_open(self):
+        self.open_circuit()
+        self.clock.now += 31
+        probes = []
+
+        def probe():
+            probes.append(1)
+            # A second request while the probe is in flight fails fast
+            self.assertRaises(ChargifyCircuitOpen, self.ok)
+            return (200, 'OK', '')
+        self.breaker.call(URL, probe)
+        self.assertEqual(probes, [1])
+        self.assertEqual(self.state(), CLOSED)
+
+    def test_closes_after_successful_probe(self):
+        self.open_circuit()
+        self.clock.now += 10
+        self.assertRaises(ChargifyCircuitOpen, self.ok)
+        self.clock.now += 21
+        self.ok()
+        self.assertEqual(self.state(), CLOSED)
+        self.ok()
+
+    def test_reopens_after_failed_probe(self):
+        self.open_circuit()
+        self.clock.now += 31
+        self.fail()
+        self.assertEqual(self.state(), OPEN)
+        self.assertRaises(ChargifyCircuitOpen, self.ok)
+
+    def test_deadline_cut_requests_are_not_counted(self):
+        def timeout():
+            self.clock.now += 1
+            raise socket.timeout('timed out')
+        for i in range(6):
+            deadline = ChargifyDeadline(1.0, self.clock)
+            deadline.__enter__()
+            try:
+                self.assertRaises(socket.timeout, self.breaker.call, URL,
+                    timeout)
+                self.assertRaises(ChargifyDeadlineExceeded,
+                    self.breaker.call, URL, deadline.remaining)
+            finally:
+                deadline.__exit__(None, None, None)
+        self.assertEqual(self.state(), CLOSED)
+
+    def test_deadline_cut_probe_lets_next_request_probe(self):
+        self.open_circuit()
+        self.clock.now += 31
+
+        def cut():
+            raise ChargifyDeadlineExceeded('out of time')
+        self.assertRaises(ChargifyDeadlineExceeded, self.breaker.call, URL,
+            cut)
+        self.assertEqual(self.state(), HALF_OPEN)
+        self.ok()
+        self.assertEqual(self.state(), CLOSED)
+
+
+if __name__ == '__main__':
+    unittest.main()
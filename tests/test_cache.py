@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of response caches and the catalog warmer.
+
+    python -m unittest discover -s tests -t .
+'''
+
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from pychargify.api import Chargify
+from pychargify.cache import ChargifyCatalogWarmer, ChargifySQLiteCache, \
+    catalog_url
+from pychargify.fake import ChargifyFakeBackend
+
+
+class CountingTransport(object):
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.urls = []
+
+    def request(self, method, url, body=None, headers=None):
+        self.urls.append(url)
+        return self.backend.request(method, url, body, headers)
+
+    def stream(self, method, url, body=None, headers=None):
+        self.urls.append(url)
+        return self.backend.stream(method, url, body, headers)
+
+
+class CatalogWarmerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = ChargifyFakeBackend()
+        family = self.fake.addProductFamily(name='Plans', handle='plans')
+        product = self.fake.addProduct(family, name='Basic', handle='basic',
+            price_in_cents=1000)
+        customer = self.fake.addCustomer(first_name='John', last_name='Doe',
+            email='john@example.com')
+        self.subscription = self.fake.addSubscription(customer, product)
+        self.transport = CountingTransport(self.fake)
+        self.chargify = Chargify('key', 'subdomain', transport=self.transport)
+        self.warmer = ChargifyCatalogWarmer(self.chargify.session)
+        self.warmer.warm()
+        del self.transport.urls[:]
+
+    def test_catalog_is_served_from_cache(self):
+        self.assertEqual(len(self.chargify.Products.getAll()), 1)
+        self.assertEqual(self.chargify.ProductFamilies.getAll()[0].name,
+            'Plans')
+        self.assertEqual(self.transport.urls, [])
+
+    def test_other_responses_are_not_cached(self):
+        id = self.subscription['id']
+        self.assertEqual(
+            self.chargify.Subscriptions.getById(id).state, 'active')
+        self.fake.subscriptions[id]['state'] = 'canceled'
+        self.assertEqual(
+            self.chargify.Subscriptions.getById(id).state, 'canceled')
+        self.assertEqual(len(self.transport.urls), 2)
+
+    def test_own_cache_caches_everything(self):
+        chargify = Chargify('key', 'subdomain', transport=self.transport,
+            cache=self.chargify.session.cache)
+        ChargifyCatalogWarmer(chargify.session)
+        self.assertTrue(chargify.session.cache_filter is None)
+
+
+class SQLiteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_entries_are_scoped_to_the_site(self):
+        a = ChargifyFakeBackend()
+        a.addProductFamily(name='A', handle='a')
+        b = ChargifyFakeBackend()
+        b.addProductFamily(name='B', handle='b')
+        site_a = Chargify('key-a', 'site-a', transport=a,
+            cache=ChargifySQLiteCache(self.path))
+        site_b = Chargify('key-b', 'site-b', transport=b,
+            cache=ChargifySQLiteCache(self.path))
+        self.assertEqual(site_a.ProductFamilies.getAll()[0].name, 'A')
+        self.assertEqual(site_b.ProductFamilies.getAll()[0].name, 'B')
+        self.assertEqual(site_a.ProductFamilies.getAll()[0].name, 'A')
+
+    def test_only_catalog_is_cached(self):
+        fake = ChargifyFakeBackend()
+        family = fake.addProductFamily(name='Plans', handle='plans')
+        product = fake.addProduct(family, name='Basic', handle='basic',
+            price_in_cents=1000)
+        customer = fake.addCustomer(first_name='John', last_name='Doe',
+            email='john@example.com')
+        id = fake.addSubscription(customer, product)['id']
+        transport = CountingTransport(fake)
+        chargify = Chargify('key', 'subdomain', transport=transport,
+            cache=ChargifySQLiteCache(self.path))
+
+        self.assertEqual(chargify.Subscriptions.getById(id).state, 'active')
+        fake.subscriptions[id]['state'] = 'canceled'
+        self.assertEqual(chargify.Subscriptions.getById(id).state, 'canceled')
+        self.assertEqual(len(transport.urls), 2)
+
+        del transport.urls[:]
+        chargify.Products.getAll()
+        chargify.Products.getAll()
+        chargify.ProductFamilies.getAll()[0].getComponents()
+        chargify.ProductFamilies.getAll()[0].getComponents()
+        self.assertEqual(transport.urls, ['/products.xml',
+            '/product_families.xml',
+            '/product_families/%s/components.xml' % family['id']])
+
+    def test_cacheable_none_caches_every_get(self):
+        cache = ChargifySQLiteCache(self.path, cacheable=None)
+        chargify = Chargify('key', 'subdomain',
+            transport=ChargifyFakeBackend(), cache=cache)
+        self.assertTrue(chargify.session.cache_filter is None)
+
+    def test_catalog_url(self):
+        self.assertEqual([catalog_url(url) for url in ('/products.xml',
+            '/products/1.xml', '/products/handle/basic.xml',
+            '/product_families.xml', '/product_families/1/components.xml',
+            '/subscriptions/1.xml', '/customers.xml',
+            '/customers/1/subscriptions.xml', '/productsx.xml')],
+            [True] * 5 + [False] * 4)
+
+    def test_file_is_private(self):
+        ChargifySQLiteCache(self.path).set('key', 'value')
+        self.assertEqual(stat.S_IMODE(os.stat(self.path).st_mode), 0600)
+
+    def test_expiry_and_eviction(self):
+        cache = ChargifySQLiteCache(self.path, max_size=250)
+        cache.set('expired', 'x', ttl=-1)
+        self.assertEqual(cache.get('expired'), None)
+        for i in range(5):
+            cache.set('key-%d' % i, 'x' * 100, ttl=60 + i)
+        self.assertEqual([cache.get('key-%d' % i) is not None
+            for i in range(5)], [False, False, False, True, True])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of changedSince listings against ChargifyFakeBackend.
+
+    python -m unittest discover -s tests -t .
+'''
+
+import datetime
+import re
+import unittest
+
+from pychargify.api import Chargify
+from pychargify.fake import ChargifyFakeBackend
+
+START = 1300000000
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = START
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingTransport(object):
+    """
+    Records listing URLs, optionally dropping the date filter so the
+    client has to stop on its own
+    """
+
+    def __init__(self, backend, filter_dates=True):
+        self.backend = backend
+        self.filter_dates = filter_dates
+        self.urls = []
+
+    def request(self, method, url, body=None, headers=None):
+        self.urls.append(url)
+        if not self.filter_dates:
+            url = re.sub(r'&start_datetime=[^&]*', '', url)
+        return self.backend.request(method, url, body, headers)
+
+
+class ChangedSinceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.fake = ChargifyFakeBackend(clock=self.clock)
+        # Customers 0 and 1 are older than since, 2 to 4 newer
+        for i in range(5):
+            self.clock.now = START + i * 60
+            self.fake.addCustomer(first_name='John', last_name='Doe',
+                email='john%d@example.com' % i)
+        self.since = datetime.datetime.fromtimestamp(START + 120)
+
+    def changes(self, per_page, filter_dates=True):
+        self.transport = RecordingTransport(self.fake, filter_dates)
+        chargify = Chargify('key', 'subdomain', transport=self.transport)
+        return chargify.Customers.changedSince(self.since, per_page)
+
+    def emails(self, changes):
+        return [c.email for c in changes]
+
+    def test_newest_first_and_watermark(self):
+        changes = self.changes(per_page=10)
+        self.assertEqual(self.emails(changes), ['john4@example.com',
+            'john3@example.com', 'john2@example.com'])
+        self.assertEqual(changes.watermark,
+            datetime.datetime.fromtimestamp(START + 240))
+        self.assertEqual(len(self.transport.urls), 1)
+        self.assertTrue('sort=updated_at' in self.transport.urls[0])
+        self.assertTrue('direction=desc' in self.transport.urls[0])
+
+    def test_short_final_page_ends_listing(self):
+        changes = self.changes(per_page=2)
+        self.assertEqual(len(self.emails(changes)), 3)
+        self.assertEqual(len(self.transport.urls), 2)
+
+    def test_full_final_page_needs_one_more_request(self):
+        self.since = datetime.datetime.fromtimestamp(START + 60)
+        changes = self.changes(per_page=2)
+        self.assertEqual(len(self.emails(changes)), 4)
+        self.assertEqual(len(self.transport.urls), 3)
+
+    def test_stops_at_first_older_object(self):
+        changes = self.changes(per_page=2, filter_dates=False)
+        self.assertEqual(self.emails(changes), ['john4@example.com',
+            'john3@example.com', 'john2@example.com'])
+        # The second page holds an older customer, no third is fetched
+        self.assertEqual(len(self.transport.urls), 2)
+
+    def test_watermark_unchanged_without_changes(self):
+        self.since = datetime.datetime.fromtimestamp(START + 600)
+        changes = self.changes(per_page=10)
+        self.assertEqual(self.emails(changes), [])
+        self.assertEqual(changes.watermark, self.since)
+
+    def test_watermark_feeds_next_call(self):
+        changes = self.changes(per_page=10)
+        list(changes)
+        self.clock.now = START + 600
+        self.fake.addCustomer(first_name='Jane', last_name='Doe',
+            email='jane@example.com')
+        self.since = changes.watermark
+        # Objects updated exactly at the watermark come again
+        self.assertEqual(self.emails(self.changes(per_page=10)),
+            ['jane@example.com', 'john4@example.com'])
+
+
+if __name__ == '__main__':
+    unittest.main()
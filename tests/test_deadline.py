@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of ChargifyDeadline and the work it bounds.
+
+    python -m unittest discover -s tests -t .
+'''
+
+import threading
+import time
+import unittest
+
+from pychargify.analytics import ChargifyUsageTotals
+from pychargify.api import Chargify, ChargifyDeadline, \
+    ChargifyDeadlineExceeded, ChargifyTransport, bind_deadline, \
+    current_deadline, deadline_timeout
+from pychargify.fake import ChargifyFakeBackend
+
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class SlowTransport(ChargifyTransport):
+    """
+    Takes delay seconds over every request and counts the requests sent
+    """
+
+    def __init__(self, backend, delay):
+        self.backend = backend
+        self.delay = delay
+        self.sent = 0
+        self._lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None):
+        self._lock.acquire()
+        try:
+            self.sent += 1
+        finally:
+            self._lock.release()
+        time.sleep(self.delay)
+        return self.backend.request(method, url, body, headers)
+
+
+class DeadlineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_remaining_and_timeout_cap(self):
+        with ChargifyDeadline(5, self.clock) as deadline:
+            self.assertEqual(deadline.remaining(), 5)
+            self.assertEqual(deadline_timeout(60), 5)
+            self.assertEqual(deadline_timeout(2), 2)
+            self.assertEqual(deadline_timeout(), 5)
+            self.clock.now += 5
+            self.assertRaises(ChargifyDeadlineExceeded, deadline.remaining)
+            self.assertRaises(ChargifyDeadlineExceeded, deadline_timeout, 60)
+        self.assertEqual(current_deadline(), None)
+        self.assertEqual(deadline_timeout(60), 60)
+
+    def test_nested_deadlines(self):
+        with ChargifyDeadline(10, self.clock) as outer:
+            # An inner deadline never outlasts the outer one
+            with ChargifyDeadline(20, self.clock):
+                self.assertTrue(current_deadline() is outer)
+            with ChargifyDeadline(3, self.clock) as inner:
+                self.assertTrue(current_deadline() is inner)
+                self.clock.now += 4
+                self.assertRaises(ChargifyDeadlineExceeded, deadline_timeout)
+            self.assertTrue(current_deadline() is outer)
+            self.assertEqual(deadline_timeout(), 6)
+        self.assertEqual(current_deadline(), None)
+
+    def test_bind_deadline_in_worker_thread(self):
+        seen = []
+
+        def work():
+            seen.append(current_deadline())
+
+        self.assertTrue(bind_deadline(work) is work)
+        with ChargifyDeadline(10, self.clock) as deadline:
+            for function in (work, bind_deadline(work)):
+                thread = threading.Thread(target=function)
+                thread.start()
+                thread.join()
+        self.assertEqual(seen, [None, deadline])
+
+    def test_bound_function_leaves_worker_clean(self):
+        seen = []
+        with ChargifyDeadline(10, self.clock):
+            bound = bind_deadline(lambda: seen.append(current_deadline()))
+
+        def work():
+            bound()
+            seen.append(current_deadline())
+        thread = threading.Thread(target=work)
+        thread.start()
+        thread.join()
+        self.assertTrue(seen[0] is not None)
+        self.assertEqual(seen[1], None)
+
+
+class DeadlineQueuedWorkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = ChargifyFakeBackend()
+        self.transport = SlowTransport(self.fake, 0.05)
+        self.chargify = Chargify('key', 'subdomain', transport=self.transport)
+
+    def assertNoMoreSent(self):
+        sent = self.transport.sent
+        time.sleep(0.2)
+        self.assertEqual(self.transport.sent, sent)
+
+    def test_unit_of_work_stops_queued_saves(self):
+        uow = self.chargify.UnitOfWork(workers=2)
+        for i in range(20):
+            customer = self.chargify.Customer()
+            customer.first_name = 'John'
+            customer.last_name = 'Doe'
+            customer.email = 'john%d@example.com' % i
+            uow.add(customer)
+        with self.chargify.deadline(0.15):
+            results = uow.flush()
+        self.assertEqual(len(results), 20)
+        failed = [r for r in results if not r[1]]
+        self.assertTrue(failed)
+        self.assertTrue(all(isinstance(r[2], ChargifyDeadlineExceeded)
+            for r in failed))
+        # Besides the saves that went through, at most one in flight per
+        # worker was sent and cut short
+        self.assertTrue(self.transport.sent <= 20 - len(failed) + 2)
+        self.assertNoMoreSent()
+
+    def test_usage_aggregation_stops_queued_fetches(self):
+        family = self.fake.addProductFamily(name='Plans', handle='plans')
+        component = self.fake.addComponent(family, name='API calls',
+            unit_name='call')
+        product = self.fake.addProduct(family, name='Basic', handle='basic',
+            price_in_cents=1000)
+        ids = []
+        for i in range(20):
+            customer = self.fake.addCustomer(first_name='John',
+                last_name='Doe', email='john%d@example.com' % i)
+            ids.append(self.fake.addSubscription(customer, product)['id'])
+
+        with self.chargify.deadline(0.15):
+            self.assertRaises(ChargifyDeadlineExceeded,
+                ChargifyUsageTotals.fromSubscriptions,
+                self.chargify.Subscription(), ids, [component['id']],
+                workers=2)
+        self.assertTrue(self.transport.sent < 20)
+        self.assertNoMoreSent()
+
+
+if __name__ == '__main__':
+    unittest.main()
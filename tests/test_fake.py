@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of ChargifyFakeBackend listings.
+
+    python -m unittest discover -s tests -t .
+'''
+
+import unittest
+
+from pychargify.api import Chargify
+from pychargify.fake import ChargifyFakeBackend
+
+
+class NestedListingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = ChargifyFakeBackend()
+        self.chargify = Chargify('key', 'subdomain', transport=self.fake)
+
+    def test_customer_subscriptions_are_filtered_before_paging(self):
+        family = self.fake.addProductFamily(name='Plans', handle='plans')
+        product = self.fake.addProduct(family, name='Basic', handle='basic',
+            price_in_cents=1000)
+        busy = self.fake.addCustomer(first_name='John', last_name='Doe',
+            email='john@example.com')
+        for i in range(25):
+            self.fake.addSubscription(busy, product)
+        other = self.fake.addCustomer(first_name='Jane', last_name='Doe',
+            email='jane@example.com')
+        self.fake.addSubscription(other, product)
+
+        customer = self.chargify.Customers.getById(other['id'])
+        self.assertEqual(len(customer.getSubscriptions()), 1)
+        customer = self.chargify.Customers.getById(busy['id'])
+        # The default page holds 20
+        self.assertEqual(len(customer.getSubscriptions()), 20)
+
+    def test_family_components_are_filtered_before_paging(self):
+        busy = self.fake.addProductFamily(name='Busy', handle='busy')
+        for i in range(25):
+            self.fake.addComponent(busy, name='Seats %d' % i,
+                kind='quantity_based_component', unit_name='seat')
+        other = self.fake.addProductFamily(name='Other', handle='other')
+        self.fake.addComponent(other, name='Users',
+            kind='quantity_based_component', unit_name='user')
+
+        family = self.chargify.ProductFamilies.getById(other['id'])
+        self.assertEqual([c.name for c in family.getComponents()], ['Users'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of the connection pool against a local HTTP server.
+
+    python -m unittest discover -s tests -t .
+'''
+
+import BaseHTTPServer
+import SocketServer
+import httplib
+import socket
+import threading
+import time
+import unittest
+
+from pychargify.api import Chargify, ChargifyConnectionPool, \
+    ChargifyDeadlineExceeded
+
+BODY = '<?xml version="1.0" encoding="UTF-8"?><customer><id>1</id></customer>'
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def respond(self):
+        server = self.server
+        server.requests.append(self.command)
+        length = int(self.headers.getheader('content-length') or 0)
+        self.rfile.read(length)
+        if server.drop_after and len(server.requests) > server.drop_after:
+            # Process the request, then drop the connection unanswered
+            server.drop_after = None
+            self.close_connection = 1
+            self.wfile.close()
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    do_GET = do_POST = respond
+
+    def log_message(self, *args):
+        pass
+
+
+class DripHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Sends a subscription body 40 bytes at a time, 10ms apart
+    """
+    protocol_version = 'HTTP/1.1'
+    body = '<?xml version="1.0" encoding="UTF-8"?><subscription><id>1</id>' \
+        '<state>active</state><reference>%s</reference></subscription>' % (
+            'x' * 2000)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        for i in range(0, len(self.body), 40):
+            self.wfile.write(self.body[i:i + 40])
+            self.wfile.flush()
+            time.sleep(0.01)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class PlainPool(ChargifyConnectionPool):
+
+    def __init__(self, port):
+        ChargifyConnectionPool.__init__(self, '127.0.0.1', 2, 5, 5)
+        self.port = port
+
+    def _new_connection(self):
+        return httplib.HTTPConnection(self.host, self.port,
+            timeout=self.connect_timeout)
+
+
+class ConnectionPoolRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.requests = []
+        self.server.drop_after = None
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.pool = PlainPool(self.server.server_address[1])
+        # Leave a keep-alive connection in the pool
+        self.pool.request('GET', '/customers/1.xml')
+        self.server.drop_after = 1
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_get_is_retried(self):
+        status, reason, body = self.pool.request('GET', '/customers/1.xml')
+        self.assertEqual(status, 200)
+        self.assertEqual(self.server.requests, ['GET', 'GET', 'GET'])
+
+    def test_post_is_not_resent(self):
+        self.assertRaises((httplib.HTTPException, socket.error),
+            self.pool.request, 'POST', '/customers.xml', '<customer/>')
+        self.assertEqual(self.server.requests, ['GET', 'POST'])
+
+
+
+class DeadlineBodyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), DripHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.pool = PlainPool(self.server.server_address[1])
+        self.chargify = Chargify('key', 'subdomain', transport=self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_slow_body_is_cut_off_at_deadline(self):
+        start = time.time()
+        with self.chargify.deadline(0.2):
+            self.assertRaises(ChargifyDeadlineExceeded,
+                self.chargify.Subscriptions.getById, 1)
+        # The whole body takes about 0.5s to arrive
+        self.assertTrue(time.time() - start < 0.4)
+
+    def test_without_deadline_body_is_read_whole(self):
+        self.assertEqual(self.chargify.Subscriptions.getById(1).state,
+            'active')
+
+
+if __name__ == '__main__':
+    unittest.main()
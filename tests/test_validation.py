@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of local record validation, with and without numpy.
+
+    python -m unittest discover -s tests -t .
+'''
+
+import datetime
+import random
+import unittest
+
+from pychargify import validation
+
+TODAY = datetime.date(2012, 6, 1)
+
+CARDS = ['4111111111111111', '4111111111111112', '5555555555554444',
+    '378282246310005', '6011111111111117', '30569309025904',
+    '4222222222222', '6759649826438453', '4111111111111111111',
+    '4111111111111111110', '79927398713', '000000000000']
+
+
+class PurePythonMixin(object):
+    """
+    Runs a test case with the numpy batch checks switched off
+    """
+
+    def setUp(self):
+        self._numpy = validation.numpy
+        validation.numpy = None
+
+    def tearDown(self):
+        validation.numpy = self._numpy
+
+
+class CreditCardTest(unittest.TestCase):
+
+    def errors(self, **fields):
+        record = {'full_number': '4111111111111111', 'expiration_month': '12',
+            'expiration_year': '2014'}
+        record.update(fields)
+        return validation.validateCreditCards([record], TODAY).errors[0]
+
+    def test_luhn(self):
+        self.assertEqual(validation.luhn_valid(CARDS), [True, False, True,
+            True, True, True, True, True, False, True, True, True])
+        self.assertEqual(validation.luhn_valid([]), [])
+
+    def test_valid_card(self):
+        self.assertEqual(self.errors(), [])
+        self.assertEqual(self.errors(full_number='4111-1111 1111-1111'), [])
+        self.assertEqual(self.errors(full_number=4111111111111111), [])
+
+    def test_card_number(self):
+        self.assertEqual(self.errors(full_number='4111111111111112'),
+            [('full_number', 'fails the Luhn check')])
+        self.assertEqual(self.errors(full_number='41111'),
+            [('full_number', 'must be 12 to 19 digits')])
+        self.assertEqual(self.errors(full_number='4111\xe91111111111'),
+            [('full_number', 'must be 12 to 19 digits')])
+        self.assertEqual(self.errors(full_number=''),
+            [('full_number', 'is required')])
+
+    def test_expiration(self):
+        self.assertEqual(self.errors(expiration_month='6',
+            expiration_year='12'), [])
+        self.assertEqual(self.errors(expiration_month='5',
+            expiration_year='2012'),
+            [('expiration_month', 'card has expired')])
+        self.assertEqual(self.errors(expiration_month=13),
+            [('expiration_month', 'month must be between 1 and 12')])
+        self.assertEqual(self.errors(expiration_year='2040'),
+            [('expiration_month', 'year is too far in the future')])
+        self.assertEqual(self.errors(expiration_month='x'),
+            [('expiration_month', 'must be a number')])
+
+    def test_billing_location(self):
+        self.assertEqual(self.errors(billing_country='us',
+            billing_state='ny'), [])
+        self.assertEqual(self.errors(billing_country='US',
+            billing_state='ZZ'),
+            [('billing_state', 'is not a state of US')])
+        self.assertEqual(self.errors(billing_country=5),
+            [('billing_country', 'is not an ISO 3166 country code')])
+        self.assertEqual(self.errors(billing_country='US', billing_state=7),
+            [('billing_state', 'is not a state of US')])
+
+
+class PurePythonCreditCardTest(PurePythonMixin, CreditCardTest):
+    pass
+
+
+class CustomerTest(unittest.TestCase):
+
+    def test_customers(self):
+        result = validation.validateCustomers([
+            {'first_name': 'John', 'last_name': 'Doe',
+                'email': 'john@example.com', 'country': 'CA', 'state': 'ON'},
+            {'first_name': ' ', 'last_name': 'Doe', 'email': 'john.example.com',
+                'country': 'CA', 'state': 'NY'},
+            {'first_name': 'John', 'last_name': 'Doe', 'email': 5,
+                'country': 5},
+        ])
+        self.assertEqual(result.errors, [
+            [],
+            [('first_name', 'is required'),
+                ('email', 'is not a valid email address'),
+                ('state', 'is not a state of CA')],
+            [('email', 'is not a valid email address'),
+                ('country', 'is not an ISO 3166 country code')],
+        ])
+        self.assertEqual(len(result.valid()), 1)
+        self.assertEqual([r[0] for r in result.rejected()], [1, 2])
+
+
+def random_cards(count, seed=1):
+    rng = random.Random(seed)
+    cards = []
+    for i in range(count):
+        length = rng.randint(10, 20)
+        cards.append({
+            'full_number': ''.join(str(rng.randint(0, 9))
+                for j in range(length)),
+            'expiration_month': rng.choice([None, '', 'x', 0, 1, 6, 12, 13,
+                '5', '7']),
+            'expiration_year': rng.choice([None, '', 11, 12, 13, 2011, 2012,
+                2031, 2032, 2033, '2015', 'y']),
+        })
+    return cards
+
+
+@unittest.skipIf(validation.numpy is None, 'numpy is not installed')
+class NumpyMatchesPurePythonTest(unittest.TestCase):
+
+    def run_both(self, function, *args):
+        numpy = validation.numpy
+        try:
+            batched = function(*args)
+            validation.numpy = None
+            return batched, function(*args)
+        finally:
+            validation.numpy = numpy
+
+    def test_luhn(self):
+        rng = random.Random(2)
+        numbers = CARDS + [''.join(str(rng.randint(0, 9))
+            for j in range(rng.randint(1, validation.MAX_CARD_DIGITS)))
+            for i in range(2000)]
+        batched, pure = self.run_both(validation.luhn_valid, numbers)
+        self.assertEqual(batched, pure)
+
+    def test_expiration(self):
+        months = [None, 0, 1, 5, 6, 7, 12, 13, -1] * 12
+        years = [y for y in (None, 0, 11, 12, 13, 32, 33, 2011, 2012, 2032,
+            2033, 99) for i in range(9)]
+        batched, pure = self.run_both(validation.expiration_errors, months,
+            years, TODAY)
+        self.assertEqual(batched, pure)
+
+    def test_batches(self):
+        cards = random_cards(3000)
+        batched, pure = self.run_both(validation.validateCreditCards, cards,
+            TODAY)
+        self.assertEqual(batched.errors, pure.errors)
+        self.assertTrue(batched.valid())
+        self.assertTrue(batched.rejected())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+'''
+Tests of webhook verification and decoding.
+
+    python -m unittest discover -s tests -t .
+'''
+
+import json
+import unittest
+import urllib
+
+from pychargify.api import Chargify, ChargifyError
+from pychargify.fake import ChargifyFakeBackend
+from pychargify.webhooks import ChargifyWebhooks, \
+    ChargifyWebhookSignatureError
+
+FORM = urllib.urlencode([
+    ('id', '42'),
+    ('event', 'signup_success'),
+    ('payload[subscription][id]', '7'),
+    ('payload[subscription][state]', 'active'),
+    ('payload[subscription][balance_in_cents]', '1500'),
+    ('payload[subscription][customer][first_name]', 'John'),
+    ('payload[subscription][customer][email]', 'john@example.com'),
+])
+
+
+class WebhooksWithoutSessionTest(unittest.TestCase):
+
+    def setUp(self):
+        self.webhooks = ChargifyWebhooks('shared-key')
+
+    def test_handle_form_payload(self):
+        event = self.webhooks.handle(FORM, self.webhooks.sign(FORM))
+        self.assertEqual(event.event, 'signup_success')
+        self.assertEqual(event.subscription.state, 'active')
+        self.assertEqual(event.subscription.balance_in_cents, 1500)
+        self.assertEqual(event.subscription.customer.first_name, 'John')
+        self.assertFalse(event.subscription.isDirty())
+
+    def test_handle_json_payload(self):
+        body = json.dumps({'id': 1, 'event': 'customer_update',
+            'payload': {'customer': {'id': 3, 'email': 'a@example.com'}}})
+        event = self.webhooks.handle(body, self.webhooks.sign(body))
+        self.assertEqual(event.customer.email, 'a@example.com')
+
+    def test_id_only_payload_is_not_refetched(self):
+        body = json.dumps({'id': 1, 'event': 'customer_update',
+            'payload': {'customer': {'id': 3}}})
+        event = self.webhooks.handle(body, self.webhooks.sign(body))
+        self.assertEqual(event.customer.id, 3)
+
+    def test_objects_cannot_send_requests(self):
+        event = self.webhooks.handle(FORM, self.webhooks.sign(FORM))
+        self.assertRaises(ChargifyError, event.subscription.getById, 7)
+
+    def test_internal_keys_are_ignored(self):
+        body = FORM + '&' + urllib.urlencode([
+            ('payload[subscription][session]', 'x'),
+            ('payload[subscription][_loaded]', ''),
+            ('payload[subscription][customer][session]', 'x'),
+        ])
+        event = self.webhooks.handle(body, self.webhooks.sign(body))
+        self.assertFalse(isinstance(event.subscription.session, basestring))
+        self.assertFalse(isinstance(event.subscription.customer.session,
+            basestring))
+        self.assertFalse(event.subscription.isDirty())
+
+    def test_unicode_form_body(self):
+        body = FORM.decode('utf-8') + u'&payload[customer][first_name]=J\xf6rg'
+        event = self.webhooks.decode(body)
+        self.assertEqual(event.customer.first_name, u'J\xf6rg')
+
+    def test_bad_signature(self):
+        self.assertRaises(ChargifyWebhookSignatureError, self.webhooks.handle,
+            FORM, 'bad')
+
+
+class WebhooksWithSessionTest(unittest.TestCase):
+
+    def test_id_only_payload_is_refetched(self):
+        fake = ChargifyFakeBackend()
+        customer = fake.addCustomer(first_name='John', last_name='Doe',
+            email='john@example.com')
+        chargify = Chargify('key', 'subdomain', transport=fake)
+        webhooks = ChargifyWebhooks('shared-key', chargify.session)
+        body = json.dumps({'id': 1, 'event': 'customer_update',
+            'payload': {'customer': {'id': customer['id']}}})
+        event = webhooks.handle(body, webhooks.sign(body))
+        self.assertEqual(event.customer.email, 'john@example.com')
+        self.assertTrue(event.customer.session is chargify.session)
+
+
+if __name__ == '__main__':
+    unittest.main()